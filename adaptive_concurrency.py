@@ -0,0 +1,197 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# AIMD (additive increase, multiplicative decrease) controller for the number of in-flight Azure OpenAI requests, shared by every thread and asyncio task of both AI steps.
+# While the smoothed call latency stays close to the best latency seen and few calls are throttled, the limit grows by one request per round of successful calls.
+# A 429 or a timeout cuts the limit by dep.concurrency_decrease_factor (at most once per round-trip), so the run settles at the highest parallelism the deployment sustains that day.
+# The threaded worker pools are sized to dep.concurrency_max, the async stages to at most dep.improve_concurrency / dep.parse_concurrency; the controller decides how many of them may call the model at the same time.
+#################################################### OVERVIEW (END) ######################################################
+
+import asyncio
+import dependencies as dep
+import logging
+import requests
+import threading
+import time
+
+from azure.core.exceptions import ServiceRequestError
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from openai import APIConnectionError, RateLimitError
+
+## ------ VARIABLES ------ ##
+latency_smoothing = 0.2 # weight of the newest call in the latency moving average
+baseline_drift = 0.01 # lets the best-seen latency follow slow, permanent changes (e.g. longer reports later in the backlog)
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def outcomeOf(error):
+    #Only throttling and timeouts signal that the deployment is saturated, other errors (e.g. content filter) leave the limit alone
+    if isinstance(error, RateLimitError) or getattr(error, 'status_code', None) == 429:
+        return 'throttled'
+    if isinstance(error, (APIConnectionError, requests.exceptions.ReadTimeout, ServiceRequestError, asyncio.TimeoutError, TimeoutError)) or getattr(error, 'status_code', None) == 408:
+        return 'timeout'
+    return 'error'
+
+
+class AdaptiveConcurrency:
+    def __init__(self, initial, min_limit, max_limit, decrease_factor, latency_tolerance, max_error_rate, enabled=True, window=50):
+        self.enabled = enabled
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.max_error_rate = max_error_rate
+        self.in_flight = 0
+        self.latency_average = None
+        self.latency_baseline = None
+        self.outcomes = deque(maxlen=window)
+        self.last_decrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self.lowest_limit = self.highest_limit = int(self.limit)
+        self.condition = threading.Condition()
+
+    def workerCount(self, fixed_workers):
+        #Pool size for a stage: enough workers to reach the max limit, or the fixed setting when the controller is off
+        return self.max_limit if self.enabled else fixed_workers
+
+    def stageWorkerCount(self, stage_limit):
+        #Pool size for one stage of the async pipeline. Each worker has one call in flight, so the stage setting stays a cap per stage and the controller caps both stages together
+        return min(self.max_limit, stage_limit) if self.enabled else stage_limit
+
+    def _tryEnter(self):
+        with self.condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    async def acquireAsync(self):
+        while not self._tryEnter():
+            await asyncio.sleep(0.05)
+
+    def release(self, latency, outcome):
+        with self.condition:
+            saturated = self.in_flight >= int(self.limit) # only grow a limit that is actually in use
+            self.in_flight -= 1
+            self.outcomes.append(outcome)
+            previous_limit = int(self.limit)
+
+            if outcome == 'ok':
+                self._observeLatency(latency)
+                if saturated and self._healthy():
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit) # +1 per round of `limit` successful calls
+            elif outcome in ('throttled', 'timeout'):
+                now = time.monotonic()
+                if now - self.last_decrease >= (self.latency_average or 1.0): # one cut per round-trip, not one per failed call of the same burst
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+
+            current_limit = int(self.limit)
+            if current_limit != previous_limit:
+                self._logChange(previous_limit, current_limit, outcome)
+            self.condition.notify_all()
+
+    def _observeLatency(self, latency):
+        if self.latency_average is None:
+            self.latency_average = self.latency_baseline = latency
+            return
+        self.latency_average += latency_smoothing * (latency - self.latency_average)
+        self.latency_baseline = min(self.latency_average, self.latency_baseline + baseline_drift * (self.latency_average - self.latency_baseline))
+
+    def _errorRate(self):
+        congested = sum(1 for outcome in self.outcomes if outcome in ('throttled', 'timeout'))
+        return congested / len(self.outcomes) if self.outcomes else 0
+
+    def _healthy(self):
+        return self.latency_average <= self.latency_baseline * self.latency_tolerance and self._errorRate() <= self.max_error_rate
+
+    def _logChange(self, previous_limit, current_limit, outcome):
+        if current_limit > previous_limit:
+            self.increases += 1
+        else:
+            self.decreases += 1
+        self.lowest_limit = min(self.lowest_limit, current_limit)
+        self.highest_limit = max(self.highest_limit, current_limit)
+        latency = f'{self.latency_average:.2f}s' if self.latency_average is not None else 'n/a'
+        reason = 'healthy' if current_limit > previous_limit else outcome
+        logger.info(f'Concurrency {previous_limit} -> {current_limit} ({reason}, avg latency {latency}, throttled/timeout rate {self._errorRate():.1%})')
+
+    def abandon(self):
+        #Gives a slot back without an outcome, when the call was never sent
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self, wait=None):
+        #wait (the rate limiter) runs while the slot is held, so a call never passes the limiter and then queues here while a retry-after pause starts,
+        #and the latency is measured from the moment the call is sent
+        if not self.enabled:
+            if wait: wait()
+            yield
+            return
+        self.acquire()
+        try:
+            if wait: wait()
+        except BaseException:
+            self.abandon()
+            raise
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            yield
+        except Exception as e:
+            outcome = outcomeOf(e)
+            raise
+        finally:
+            self.release(time.perf_counter() - start, outcome)
+
+    @asynccontextmanager
+    async def slotAsync(self, wait=None):
+        #Same as slot, wait is an async callable
+        if not self.enabled:
+            if wait: await wait()
+            yield
+            return
+        await self.acquireAsync()
+        try:
+            if wait: await wait()
+        except BaseException:
+            self.abandon()
+            raise
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            yield
+        except Exception as e:
+            outcome = outcomeOf(e)
+            raise
+        finally:
+            self.release(time.perf_counter() - start, outcome)
+
+    def stats(self):
+        with self.condition:
+            return {'enabled': self.enabled, 'limit': int(self.limit), 'lowest_limit': self.lowest_limit, 'highest_limit': self.highest_limit,
+                    'increases': self.increases, 'decreases': self.decreases,
+                    'avg_latency_seconds': round(self.latency_average, 4) if self.latency_average is not None else None}
+
+    def logStats(self):
+        if not self.enabled: return
+        stats = self.stats()
+        logger.info(f"Adaptive concurrency: ended at {stats['limit']} in-flight requests (range {stats['lowest_limit']}-{stats['highest_limit']}, {stats['increases']} increases, {stats['decreases']} decreases)")
+
+
+shared_controller = AdaptiveConcurrency(dep.num_workers, dep.concurrency_min, dep.concurrency_max, dep.concurrency_decrease_factor,
+                                        dep.concurrency_latency_tolerance, dep.concurrency_max_error_rate, dep.adaptive_concurrency)
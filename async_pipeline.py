@@ -0,0 +1,143 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Asynchronous alternative to the two-phase (improve everything, then parse everything) processing in main.py.
+# Every row is pushed through a queue to a pool of improve workers, and as soon as the improved text for a row arrives it is handed to a pool of parse workers.
+# Each stage has its own bounded concurrency (dep.improve_concurrency / dep.parse_concurrency, within the shared limit of adaptive_concurrency.py when enabled), so the wall time follows the slower of the two stages instead of their sum.
+#################################################### OVERVIEW (END) ######################################################
+
+import adaptive_concurrency as adaptConc
+import asyncio
+import dependencies as dep
+import failure_queue as failQueue
+import improve_text_gpt_35_turbo as imprText
+import logging
+import pandas as pd
+import parsing_topics_gpt_35_turbo as parsTop
+import runtime_context as runtime
+import topic_preclassifier as preClass
+
+## ------ VARIABLES ------ ##
+_STOP = object() # sentinel telling a worker that its queue is drained
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+async def improveWorker(client, improve_queue, parse_queue, improved, parsed, audited, preclassify):
+    while True:
+        row = await improve_queue.get()
+        try:
+            if row is _STOP: return
+            if pd.isnull(row.get('aiimproveddescription')): #rows resumed from the journal skip the improve call
+                try:
+                    row_index, improved_text = await imprText.aiImprovedResponseAsync(client, row)
+                except Exception as e:
+                    #An unexpected error fails this row only, a dead worker would leave the producer waiting on a full queue
+                    logger.exception(f"Improving row {row['idmemo']} failed")
+                    failQueue.shared_queue.record('improve', row, e)
+                    continue
+                row = row.copy()
+                row['aiimproveddescription'] = improved_text
+            improved[row.name] = row['aiimproveddescription']
+            if preclassify:
+                local_results, llm_rows, audited_rows = preClass.shared_preclassifier.split([row])
+                parsed.update(local_results)
+                audited.update(audited_rows)
+                if not llm_rows: continue
+            await parse_queue.put(row)
+        finally:
+            improve_queue.task_done()
+
+async def collectParseRows(parse_queue, parse_batch_size):
+    #Returns (rows, stop). Waits up to dep.parse_batch_wait seconds for more improved rows to fill a batch
+    rows = []
+    row = await parse_queue.get()
+    parse_queue.task_done()
+    if row is _STOP: return rows, True
+    rows.append(row)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + dep.parse_batch_wait
+    while len(rows) < parse_batch_size:
+        try:
+            row = await asyncio.wait_for(parse_queue.get(), max(0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            break
+        parse_queue.task_done()
+        if row is _STOP: return rows, True
+        rows.append(row)
+    return rows, False
+
+async def parseSafely(request, rows):
+    #Returns the results of one parse request as a list; an unexpected error fails its rows instead of ending the worker
+    try:
+        result = await request
+    except Exception as e:
+        logger.exception(f"Parsing {len(rows)} rows failed")
+        for row in rows:
+            failQueue.shared_queue.record('parse', row, e)
+        return []
+    return result if isinstance(result, list) else [result]
+
+async def parseWorker(client, parse_queue, parsed, parse_batch_size):
+    while True:
+        rows, stop = await collectParseRows(parse_queue, parse_batch_size)
+        results = []
+        if parse_batch_size > 1:
+            for batch in parsTop.splitParseBatches(rows, parse_batch_size, dep.parse_batch_token_budget):
+                results.extend(await parseSafely(parsTop.aiTopicResponseBatchAsync(client, batch), batch))
+        else:
+            for row in rows:
+                results.extend(await parseSafely(parsTop.aiTopicResponseAsync(client, row), [row]))
+
+        for result in results:
+            if result:
+                row_index, updates = result
+                parsed[row_index] = updates
+        if stop: return
+
+async def processRows(dataset_df, parse_batch_size, preclassify):
+    client = runtime.shared_context.asyncAzureClient()
+    improved, parsed, audited = {}, {}, {}
+
+    # Bounded queues keep the producer from materializing every row copy at once
+    # The pool sizes cap the in-flight calls per stage; with adaptive concurrency the shared controller also caps both stages together
+    improve_workers_count = adaptConc.shared_controller.stageWorkerCount(dep.improve_concurrency)
+    parse_workers_count = adaptConc.shared_controller.stageWorkerCount(dep.parse_concurrency)
+    improve_queue = asyncio.Queue(maxsize = improve_workers_count * 2)
+    parse_queue = asyncio.Queue(maxsize = parse_workers_count * max(parse_batch_size, 2))
+
+    improve_workers = [asyncio.create_task(improveWorker(client, improve_queue, parse_queue, improved, parsed, audited, preclassify)) for _ in range(improve_workers_count)]
+    parse_workers = [asyncio.create_task(parseWorker(client, parse_queue, parsed, parse_batch_size)) for _ in range(parse_workers_count)]
+
+    async def produce():
+        for _, row in dataset_df.iterrows():
+            await improve_queue.put(row)
+        for _ in improve_workers:
+            await improve_queue.put(_STOP)
+        await asyncio.gather(*improve_workers)
+        for _ in parse_workers:
+            await parse_queue.put(_STOP)
+
+    try:
+        #Awaited together, so an error that still ends a worker is raised here instead of leaving the producer blocked on a full queue
+        await asyncio.gather(produce(), *improve_workers, *parse_workers)
+    finally:
+        for task in improve_workers + parse_workers:
+            task.cancel()
+        await client.close()
+
+    if audited:
+        preClass.shared_preclassifier.audit(audited, {row_index: parsed[row_index]['aiparsedtopics'] for row_index in audited if row_index in parsed})
+    return improved, parsed
+
+def runPipeline(dataset_df, parse_batch_size=1, preclassify=False):
+    improved, parsed = asyncio.run(processRows(dataset_df, parse_batch_size, preclassify))
+
+    dataset_df['aiimproveddescription'] = pd.Series(improved, dtype=object).reindex(dataset_df.index)
+    parsTop.applyParseResults(dataset_df, parsed.items())
+
+    logger.info(f'Async pipeline finished with:\n Improved text rows: {len(improved)} \n Parsed rows: {len(parsed)}')
+    return dataset_df
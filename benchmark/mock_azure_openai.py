@@ -0,0 +1,175 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Local HTTP stand-in for the Azure OpenAI chat completions endpoint, used by the benchmark so throughput can be measured without spending real quota.
+# It answers /openai/deployments/<deployment>/chat/completions with responses shaped like the real service (improved text, topic lists, batched JSON topics),
+# after a log-normal latency. A configurable share of requests gets a 429 (with retry-after), a 400 (content filter) or hangs until the connection is dropped (timeout).
+# Every response carries x-ratelimit-remaining-requests / x-ratelimit-remaining-tokens headers computed from a per-minute quota.
+#################################################### OVERVIEW (END) ######################################################
+
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+## ------ VARIABLES ------ ##
+default_topics = ['Inadequate maintenance', 'Failure to follow rules and regulations', 'Poor housekeeping', 'Adverse weather conditions', 'Defective equipment, machinery or tools', 'Cargo', 'Lack of knowledge']
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+class MockSettings:
+    def __init__(self, latency_median=0.4, latency_sigma=0.5, rate_429=0.0, rate_400=0.0, rate_timeout=0.0, timeout_seconds=5.0,
+                 requests_per_minute=6000, tokens_per_minute=1000000, retry_after=1, topics=None, seed=None):
+        self.latency_median = latency_median # seconds, median of the log-normal latency distribution
+        self.latency_sigma = latency_sigma # spread of the log-normal latency distribution
+        self.rate_429 = rate_429 # share of requests answered with 429 Too Many Requests
+        self.rate_400 = rate_400 # share of requests answered with a 400 content filter error
+        self.rate_timeout = rate_timeout # share of requests that hang for timeout_seconds and are then dropped
+        self.timeout_seconds = timeout_seconds
+        self.requests_per_minute = requests_per_minute # quota behind the x-ratelimit-remaining-* headers, exceeding it returns 429
+        self.tokens_per_minute = tokens_per_minute
+        self.retry_after = retry_after
+        self.topics = topics or default_topics
+        self.random = random.Random(seed)
+
+
+class QuotaWindow:
+    #Sliding one-minute window of accepted requests and tokens, like the quota of an Azure deployment
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.events = []
+        self.lock = threading.Lock()
+
+    def book(self, tokens):
+        #Returns (accepted, remaining_requests, remaining_tokens)
+        with self.lock:
+            now = time.monotonic()
+            self.events = [(stamp, used) for stamp, used in self.events if now - stamp < 60]
+            used_requests = len(self.events)
+            used_tokens = sum(used for _, used in self.events)
+            accepted = used_requests + 1 <= self.requests_per_minute and used_tokens + tokens <= self.tokens_per_minute
+            if accepted:
+                self.events.append((now, tokens))
+                used_requests += 1
+                used_tokens += tokens
+            return accepted, max(0, self.requests_per_minute - used_requests), max(0, self.tokens_per_minute - used_tokens)
+
+
+def completionContent(messages, settings):
+    user_content = messages[-1]['content'] if messages else ''
+    if user_content.startswith('Original text:'):
+        text = user_content[len('Original text:'):].strip()
+        return f"The following was reported: {text[0].upper() + text[1:] if text else text}"
+    if user_content.startswith('{'):
+        try:
+            reports = json.loads(user_content)
+        except ValueError:
+            reports = {}
+        return json.dumps({report_id: settings.random.sample(settings.topics, k=settings.random.randint(1, 3)) for report_id in reports})
+    return '\n'.join(settings.random.sample(settings.topics, k=settings.random.randint(1, 4)))
+
+
+def makeHandler(settings, quota, stats):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args): #keep the benchmark output readable
+            return
+
+        def sendJson(self, status, body, headers=None):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, str(value))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not re.match(r'^/openai/deployments/[^/]+/chat/completions', self.path):
+                self.sendJson(404, {'error': {'code': '404', 'message': 'Resource not found'}})
+                return
+            request = json.loads(body or b'{}')
+            messages = request.get('messages', [])
+            prompt_tokens = sum(len(message.get('content', '')) for message in messages) // 4 + 4 * len(messages)
+            tokens = prompt_tokens + int(request.get('max_tokens') or 0)
+
+            with stats['lock']:
+                stats['requests'] += 1
+            outcome = settings.random.random()
+            accepted, remaining_requests, remaining_tokens = quota.book(tokens)
+            rate_headers = {'x-ratelimit-remaining-requests': remaining_requests, 'x-ratelimit-remaining-tokens': remaining_tokens}
+
+            if not accepted or outcome < settings.rate_429:
+                self.count('429')
+                self.sendJson(429, {'error': {'code': '429', 'message': 'Requests to the ChatCompletions_Create Operation have exceeded the rate limit.'}},
+                              dict(rate_headers, **{'retry-after': settings.retry_after}))
+                return
+            if outcome < settings.rate_429 + settings.rate_400:
+                self.count('400')
+                self.sendJson(400, {'error': {'code': 'content_filter', 'message': "The response was filtered due to the prompt triggering Azure OpenAI's content management policy.", 'param': 'prompt', 'status': 400}}, rate_headers)
+                return
+            if outcome < settings.rate_429 + settings.rate_400 + settings.rate_timeout:
+                self.count('timeout')
+                time.sleep(settings.timeout_seconds)
+                self.close_connection = True
+                return
+
+            time.sleep(settings.random.lognormvariate(math.log(settings.latency_median), settings.latency_sigma))
+            content = completionContent(messages, settings)
+            completion_tokens = len(content) // 4
+            self.count('200')
+            self.sendJson(200, {
+                'id': f'chatcmpl-mock-{stats["requests"]}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': 'gpt-35-turbo',
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+            }, rate_headers)
+
+        def count(self, outcome):
+            with stats['lock']:
+                stats['responses'][outcome] = stats['responses'].get(outcome, 0) + 1
+
+    return MockHandler
+
+
+class MockAzureOpenAI:
+    def __init__(self, settings=None, host='127.0.0.1', port=0):
+        self.settings = settings or MockSettings()
+        self.stats = {'lock': threading.Lock(), 'requests': 0, 'responses': {}}
+        quota = QuotaWindow(self.settings.requests_per_minute, self.settings.tokens_per_minute)
+        self.server = ThreadingHTTPServer((host, port), makeHandler(self.settings, quota, self.stats))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info(f'Mock Azure OpenAI listening on {self.endpoint}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def snapshot(self):
+        with self.stats['lock']:
+            return {'requests': self.stats['requests'], 'responses': dict(self.stats['responses'])}
@@ -0,0 +1,199 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Offline benchmark of the whole microservice. It starts the local mock Azure OpenAI server (mock_azure_openai.py), feeds main.main() with synthetic reports (synthetic_reports.py)
+# instead of the database and collects the written rows in a pluggable sink: in memory by default, or a throwaway schema in a local Postgres (--postgres, uses the DB_* variables from .env).
+# Every combination of pipeline / num_workers / chunk_size runs in its own process, so module state and peak memory do not leak between runs.
+# Reports rows/sec, wall time and peak memory per combination, and writes the full results (including the run report of each run) to a JSON file.
+#
+# USAGE: python benchmark/run_benchmark.py --rows 2000 --workers 2,4,8 --chunk-sizes 100,200 --pipelines threaded,async
+#################################################### OVERVIEW (END) ######################################################
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(benchmark_dir)
+sys.path[:0] = [repo_dir, benchmark_dir]
+
+import mock_azure_openai as mockAzure
+import synthetic_reports as synthReports
+
+## ------ VARIABLES ------ ##
+benchmark_schema = 'safetyai_benchmark'
+destination_ddl = f"""CREATE TABLE {benchmark_schema}.ai_results (
+                        idmemo BIGINT PRIMARY KEY, changeddate TIMESTAMP, shortdescription TEXT, aiimproveddescription TEXT, aiparsedtopics TEXT[],
+                        lastrundate TIMESTAMP, updatedate TIMESTAMP, source TEXT, aiparsedtopics2 JSON, texthash TEXT)
+                    """
+
+## ------ FUNCTIONS ------ ##
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark against a mock Azure OpenAI endpoint')
+    parser.add_argument('--rows', type=int, default=1000, help='number of synthetic reports per run')
+    parser.add_argument('--workers', default='4', help='comma separated num_workers values (improve/parse concurrency for the async pipeline)')
+    parser.add_argument('--chunk-sizes', default='200', help='comma separated chunk_size values')
+    parser.add_argument('--pipelines', default='threaded', help='comma separated pipelines: threaded,async')
+    parser.add_argument('--stream', action='store_true', help='read the synthetic reports in streamed batches (main.py --stream)')
+    parser.add_argument('--extra-args', default='', help='extra arguments passed on to main.main(), e.g. "--parse-batch-size 8"')
+    parser.add_argument('--latency-median', type=float, default=0.4, help='median mock latency in seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='spread of the log-normal mock latency')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--rate-400', type=float, default=0.0, help='share of requests answered with a 400 content filter error')
+    parser.add_argument('--rate-timeout', type=float, default=0.0, help='share of requests that hang and are dropped')
+    parser.add_argument('--timeout-seconds', type=float, default=5.0, help='how long a simulated timeout hangs')
+    parser.add_argument('--rpm', type=int, default=6000, help='requests-per-minute quota of the mock deployment (and of the rate limiter)')
+    parser.add_argument('--tpm', type=int, default=1000000, help='tokens-per-minute quota of the mock deployment (and of the rate limiter)')
+    parser.add_argument('--postgres', action='store_true', help='write to a throwaway schema in the Postgres database from the DB_* variables instead of memory')
+    parser.add_argument('--output', default='benchmark_results.json', help='file for the full results')
+    return parser.parse_args(argv)
+
+
+def peakMemoryMb():
+    try:
+        import resource
+    except ImportError: #not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024, 1) #bytes on macOS, kilobytes on Linux
+
+
+def installSource(dbConn, rows, stream_batch_size):
+    #Replaces the database read with the synthetic reports, formatted exactly like readFromDatabase does
+    dbConn.databaseConnection = lambda: None
+    dbConn.refreshUnchangedRows = lambda: 0 # every synthetic report is new
+    dbConn.readFromDatabase = lambda conn, SQL_SELECT: dbConn.formatDataframe(rows, synthReports.columns)
+
+    def readFromDatabaseStream(conn, SQL_SELECT, batch_size):
+        for i in range(0, len(rows), batch_size):
+            yield dbConn.formatDataframe(rows[i:i + batch_size], synthReports.columns)
+    dbConn.readFromDatabaseStream = readFromDatabaseStream
+
+
+def installMemorySink(dbConn, written):
+    def writeBatchToDatabase(df):
+        written['rows'] += len(df)
+    dbConn.writeBatchToDatabase = writeBatchToDatabase
+
+
+def runConfiguration(config, endpoint, result_queue):
+    #Runs in its own process: configures the modules, runs main.main() once and reports the measurements
+    os.environ.update({'AZURE_OPENAI_API_KEY': 'benchmark', 'AZURE_OPENAI_ENDPOINT': endpoint, 'LOG_LEVEL': 'WARNING'})
+    for name, value in (('DB_HOST', 'localhost'), ('DB_HOST_NAME', 'benchmark'), ('DB_PORT_ID', '5432'), ('DB_USERNAME', 'benchmark'), ('DB_USER_PWD', 'benchmark')):
+        os.environ.setdefault(name, value) #only read when a DB connection is made, which the in-memory sink never does
+    os.chdir(repo_dir) #../.env is read relative to the working directory
+
+    import dependencies as dep
+    work_dir = tempfile.mkdtemp(prefix='safetyai_benchmark_')
+    dep.num_workers = dep.improve_concurrency = dep.parse_concurrency = config['num_workers']
+    dep.chunk_size = config['chunk_size']
+    dep.requests_per_minute, dep.tokens_per_minute = config['rpm'], config['tpm']
+    dep.cache_enabled = False # every run must reach the mock endpoint
+    dep.journal_path = os.path.join(work_dir, 'checkpoint_journal.jsonl')
+    dep.run_report_path = os.path.join(work_dir, 'run_report.json')
+    if config['postgres']:
+        dep.destination_table = f'{benchmark_schema}.ai_results' #before database_connection builds its SQL statements
+
+    import database_connection as dbConn
+    import main
+    rows = list(synthReports.generateReports(config['rows']))
+    installSource(dbConn, rows, dep.stream_batch_size)
+    written = {'rows': 0}
+    if not config['postgres']:
+        installMemorySink(dbConn, written)
+
+    os.chdir(work_dir) #the Parquet export and the failure queue of the run land in the temporary directory
+    argv = ['--pipeline', config['pipeline']] + (['--stream'] if config['stream'] else []) + config['extra_args'].split()
+    start = time.perf_counter()
+    main.main(argv)
+    wall_seconds = time.perf_counter() - start
+
+    with open(dep.run_report_path, encoding='utf-8') as report_file:
+        run_report = json.load(report_file)
+    rows_written = written['rows'] if not config['postgres'] else run_report['stages'].get('db_write', {}).get('rows', 0)
+    result_queue.put(dict(config,
+                          wall_seconds=round(wall_seconds, 2),
+                          rows_written=rows_written,
+                          rows_per_second=round(len(rows) / wall_seconds, 2),
+                          peak_rss_mb=peakMemoryMb(),
+                          run_report=run_report))
+
+
+def preparePostgres():
+    import psycopg2
+    conn = psycopg2.connect(host=os.environ['DB_HOST'], dbname=os.environ['DB_HOST_NAME'], user=os.environ['DB_USERNAME'], password=os.environ['DB_USER_PWD'], port=os.environ['DB_PORT_ID'])
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {benchmark_schema} CASCADE')
+        cursor.execute(f'CREATE SCHEMA {benchmark_schema}')
+        cursor.execute(destination_ddl)
+    return conn
+
+
+def dropPostgres(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {benchmark_schema} CASCADE')
+    conn.close()
+
+
+def waitForResult(process, result_queue):
+    #Read before join(): a child with a large result in the queue only exits once it has been read
+    while True:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive() and result_queue.empty(): return None
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    settings = mockAzure.MockSettings(latency_median=args.latency_median, latency_sigma=args.latency_sigma, rate_429=args.rate_429, rate_400=args.rate_400,
+                                      rate_timeout=args.rate_timeout, timeout_seconds=args.timeout_seconds, requests_per_minute=args.rpm, tokens_per_minute=args.tpm)
+    server = mockAzure.MockAzureOpenAI(settings).start()
+    context = multiprocessing.get_context('spawn') #fresh interpreter per run: no shared module state, honest peak memory
+
+    if args.postgres:
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_path=os.path.join(repo_dir, '..', '.env'))
+
+    results = []
+    try:
+        combinations = itertools.product(args.pipelines.split(','), [int(value) for value in args.workers.split(',')], [int(value) for value in args.chunk_sizes.split(',')])
+        for pipeline, num_workers, chunk_size in combinations:
+            pg_conn = preparePostgres() if args.postgres else None
+            config = {'pipeline': pipeline, 'num_workers': num_workers, 'chunk_size': chunk_size, 'rows': args.rows, 'stream': args.stream,
+                      'extra_args': args.extra_args, 'rpm': args.rpm, 'tpm': args.tpm, 'postgres': args.postgres}
+            requests_before = server.snapshot()['requests']
+            result_queue = context.Queue()
+            process = context.Process(target=runConfiguration, args=(config, server.endpoint, result_queue))
+            process.start()
+            result = waitForResult(process, result_queue)
+            process.join()
+            if pg_conn: dropPostgres(pg_conn)
+            if result is None:
+                print(f'{pipeline:>9} workers={num_workers:<3} chunk={chunk_size:<5} FAILED (exit code {process.exitcode})', flush=True)
+                continue
+
+            result['mock_requests'] = server.snapshot()['requests'] - requests_before
+            results.append(result)
+            print(f"{pipeline:>9} workers={num_workers:<3} chunk={chunk_size:<5} rows={args.rows:<7} wall={result['wall_seconds']:>8.2f}s "
+                  f"rows/s={result['rows_per_second']:>8.2f} peak_rss={result['peak_rss_mb']}MB requests={result['mock_requests']}", flush=True)
+    finally:
+        server.stop()
+
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump({'mock_settings': {key: value for key, value in vars(settings).items() if key != 'random'}, 'mock_responses': server.snapshot()['responses'], 'results': results},
+                  output_file, indent=2, default=str)
+    print(f'Full results written to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Generator of synthetic improvement reports for the benchmark, shaped like the output of dep.SELECT_sql_script
+# (idmemo, changeddate, _value, updatedate, template_name, texthash). The free-text descriptions are assembled from maritime phrases with crew rank abbreviations,
+# typos and attachment references, with a configurable share of exact and near-duplicate descriptions (as when reports are copied across sister vessels).
+#################################################### OVERVIEW (END) ######################################################
+
+import hashlib
+import random
+
+from datetime import datetime, timedelta
+
+## ------ VARIABLES ------ ##
+columns = ['idmemo', 'changeddate', '_value', 'updatedate', 'template_name', 'texthash']
+templates = ['Improvement report', 'Near miss report', 'Safety observation', 'Non-conformity report']
+ranks = ['C/O', '2/O', '3/O', 'C/E', '2/E', '3/E', 'AB', 'OS', 'Bosun', 'ETO', 'Oiler']
+locations = ['E/R', 'fwd mooring deck', 'aft mooring deck', 'cargo hold no. 3', 'bridge', 'galley', 'pump room', 'steering gear room', 'accommodation ladder', 'ballast tank 2P']
+events = [
+    '{rank} found oil leakage from {equipment} in {location}',
+    '{rank} slipped on wet surface in {location} while carrying tools',
+    '{rank} observed crew member working aloft w/o safety harness near {location}',
+    'during mooring ops a rope parted at {location}, no injuries',
+    '{equipment} tripped during watch, {rank} restarted it after inspection',
+    'heavy rolling in bad wx caused cargo lashings to loosen in {location}',
+    'fire alarm activated in {location} due to smoke from {equipment}',
+    '{rank} noticed missing guard on {equipment} in {location}',
+    'PPE not used properly by {rank} during chipping work at {location}',
+    'poor housekeeping in {location}, rags and oily waste not disposed',
+]
+equipment = ['aux engine no.2', 'ME lube oil pump', 'fwd winch', 'provision crane', 'purifier', 'emergency generator', 'bow thruster', 'FW generator', 'OWS', 'air compressor']
+follow_ups = ['Toolbox meeting held with crew.', 'Reported to C/E and repaired by ship staff.', 'See attached photo.', 'Risk assessment to be updated.', 'Spare parts reqested from office.', 'Area cleaned and barriers put in place.', '']
+
+## ------ FUNCTIONS ------ ##
+def description(rng, sentences):
+    parts = []
+    for _ in range(sentences):
+        event = rng.choice(events).format(rank=rng.choice(ranks), equipment=rng.choice(equipment), location=rng.choice(locations))
+        parts.append(event[0].upper() + event[1:] + '.')
+    parts.append(rng.choice(follow_ups))
+    return ' '.join(part for part in parts if part)
+
+def nearDuplicate(rng, text):
+    #Trivial edits crews make when re-filing a report: case, whitespace and a changed follow-up line
+    edit = rng.random()
+    if edit < 0.33: return text.lower()
+    if edit < 0.66: return '  ' + text.replace('. ', '.  ') + ' '
+    return text.rsplit('.', 2)[0] + '. ' + rng.choice(follow_ups)
+
+def textHash(text):
+    #Same normalization as dep.texthash_sql, with a fixed version instead of the prompt hash
+    return hashlib.md5((' '.join((text or '').split()).lower() + '|benchmark').encode('utf-8')).hexdigest()
+
+def generateReports(count, seed=42, duplicate_rate=0.15, near_duplicate_rate=0.1, null_rate=0.01, min_sentences=1, max_sentences=6, start_idmemo=1000000):
+    #Yields rows as tuples in the column order of dep.SELECT_sql_script
+    rng = random.Random(seed)
+    base_date = datetime(2024, 1, 1)
+    previous = []
+    for i in range(count):
+        roll = rng.random()
+        if previous and roll < duplicate_rate:
+            text = rng.choice(previous)
+        elif previous and roll < duplicate_rate + near_duplicate_rate:
+            text = nearDuplicate(rng, rng.choice(previous))
+        elif roll < duplicate_rate + near_duplicate_rate + null_rate:
+            text = None
+        else:
+            text = description(rng, rng.randint(min_sentences, max_sentences))
+            previous.append(text)
+            if len(previous) > 500: previous.pop(0)
+
+        changeddate = base_date + timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+        updatedate = changeddate - timedelta(days=rng.randint(1, 30)) if rng.random() < 0.3 else None #70% never processed before
+        yield (start_idmemo + i, changeddate, text, updatedate, rng.choice(templates), textHash(text))
+
+def generateBatches(count, batch_size, **kwargs):
+    batch = []
+    for row in generateReports(count, **kwargs):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch: yield batch
@@ -0,0 +1,83 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Append-only journal (one JSON line per result) of every completed text improvement and topic parsing, keyed by idmemo + changeddate.
+# Results are written and flushed as they land, so an OOM, pod eviction or Ctrl-C does not throw away the API calls that already succeeded.
+# Running main.py with --resume replays the journal: finished rows are restored without calling the model, rows that were only improved go straight to parsing.
+#################################################### OVERVIEW (END) ######################################################
+
+import dependencies as dep
+import json
+import logging
+import os
+import pandas as pd
+import threading
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def journalKey(idmemo, changeddate):
+    return f"{idmemo}|{pd.Timestamp(changeddate).isoformat() if pd.notnull(changeddate) else ''}"
+
+
+class CheckpointJournal:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def start(self, resume):
+        #A fresh run starts an empty journal, a resumed run keeps appending to the existing one
+        completed = self.replay() if resume else {}
+        self.file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        return completed
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def record(self, stage, row, result):
+        if self.file is None: return
+        line = json.dumps({'key': journalKey(row['idmemo'], row['changeddate']), 'stage': stage, 'result': result})
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def replay(self):
+        completed = {}
+        if not os.path.exists(self.path): return completed
+        with open(self.path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning('Skipping incomplete journal line (the previous run was interrupted while writing it)')
+                    continue
+                completed.setdefault(entry['key'], {})[entry['stage']] = entry['result']
+        logger.info(f'Replayed checkpoint journal: {len(completed)} rows with completed results')
+        return completed
+
+    def restoreRows(self, dataset_df, completed):
+        #Returns (rows that are fully done, rows that still need the model). Pending rows with a journaled improvement carry it in aiimproveddescription
+        if not completed: return dataset_df.iloc[0:0], dataset_df
+
+        keys = [journalKey(idmemo, changeddate) for idmemo, changeddate in zip(dataset_df['idmemo'], dataset_df['changeddate'])]
+        improved = pd.Series([completed.get(key, {}).get('improve') for key in keys], index=dataset_df.index, dtype=object)
+        parsed = pd.Series([completed.get(key, {}).get('parse') for key in keys], index=dataset_df.index, dtype=object)
+
+        dataset_df = dataset_df.copy()
+        dataset_df['aiimproveddescription'] = improved
+        done = parsed.notna() & improved.notna()
+
+        done_df = dataset_df[done].copy()
+        done_df['aiparsedtopics'] = [topics['aiparsedtopics'] for topics in parsed[done]]
+        done_df['aiparsedtopics2'] = [topics['aiparsedtopics2'] for topics in parsed[done]]
+
+        logger.info(f'Resuming: {done.sum()} rows restored from the journal, {(improved.notna() & ~done).sum()} rows only need topic parsing')
+        return done_df, dataset_df[~done]
+
+
+shared_journal = CheckpointJournal(dep.journal_path)
@@ -1,6 +1,6 @@
 #################################################### OVERVIEW (START) ######################################################
-# LAST CHANGES [AUTHOR]: Erlend Skinnemoen
-# LAST CHANGES [DATE]: 29.02.2024
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
 #
 # DESCRIPTION 
 # Facilitates interactions with a PostgreSQL database, including establishing connections, reading data, and writing data back to the database. 
@@ -8,36 +8,31 @@
 #################################################### OVERVIEW (END) ######################################################
 
 import dependencies as dep
+import io
 import logging 
-import os 
 import pandas as pd
 import psycopg2 as sql
-import urllib.parse
+import runtime_context as runtime
+import time
 
-from sqlalchemy import create_engine
+from contextlib import contextmanager
 from datetime import datetime
 
-## ------ VARIABLES ------ ##
-host = os.environ["DB_HOST"]
-dbname = os.environ["DB_HOST_NAME"]
-user= os.environ["DB_USERNAME"]
-password = os.environ["DB_USER_PWD"]
-port= os.environ["DB_PORT_ID"]
-
-
 ## ------ FUNCTIONS ------ ##
 logger = logging.getLogger(__name__)
 
-def fill_if_empty(cell):
-    if isinstance(cell, pd.Timestamp):
-        return cell
-    else:
-        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+def formatDataframe(rows, column_names):
+    df = pd.DataFrame(rows, columns=column_names)
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    df.insert(3,'lastrundate',now)
+    df['updatedate'] = df['updatedate'].astype(object).where(df['updatedate'].notna(), now) #rows never processed before get the current time
+    return df
 
 
 def databaseConnection():
+    #Checked out from the shared engine's pool, closing it returns it to the pool
     try: 
-        conn = sql.connect(host=host, dbname=dbname, user=user, password=password,  port=port) 
+        conn = runtime.shared_context.dbEngine().raw_connection()
 
         logger.info("Connected succesfully to the DB")
         return conn
@@ -46,15 +41,14 @@ def databaseConnection():
         raise
     
 def readFromDatabase(conn, SQL_SELECT):
+    cursor = None
     try: 
         cursor = conn.cursor()
         cursor.execute(SQL_SELECT)
         logger.info("Successfully executed READ and SELECT statement ")
         
         column_names = [desc[0] for desc in cursor.description]
-        df = pd.DataFrame(cursor.fetchall(), columns=column_names)
-        df.insert(3,'lastrundate',datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        df['updatedate'] = df['updatedate'].apply(fill_if_empty)
+        df = formatDataframe(cursor.fetchall(), column_names)
         logger.info("Successfully created and formatted dataframe")
 
         return df
@@ -66,22 +60,45 @@ def readFromDatabase(conn, SQL_SELECT):
     finally: 
         if cursor: 
             cursor.close()
-        if conn and conn.status == sql.extensions.STATUS_READY:
+        if conn: # always, a pooled connection is only returned to the pool by close()
             conn.close()
 
+def readFromDatabaseStream(conn, SQL_SELECT, batch_size):
+    #Named (server-side) cursor: postgres keeps the result set and only batch_size rows at a time are transferred and held in memory
+    cursor = None
+    try: 
+        cursor = conn.cursor(name='ai_backlog_cursor')
+        cursor.itersize = batch_size
+        cursor.execute(SQL_SELECT)
+        logger.info("Successfully executed streaming READ and SELECT statement ")
 
-url_parse_pwd = urllib.parse.quote_plus(password) #due to sqlalchemy limitations: https://docs.sqlalchemy.org/en/14/core/engines.html#database-urls
-connection_string = f"postgresql+psycopg2://{user}:{url_parse_pwd}@{host}:{port}/{dbname}"
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows: break
+            column_names = [desc[0] for desc in cursor.description]
+            yield formatDataframe(rows, column_names)
 
-engine = create_engine(connection_string)
-stage_sql = f"""/*the temp table part*/
-                CREATE TEMPORARY TABLE IF NOT exists stage_table AS SELECT * 
-                FROM {dep.destination_table} WHERE 1<>1
-            """
+    except (Exception, sql.DatabaseError) as e:
+        logger.critical(f'Failed to execute function, with following error: {e}')
+        raise
 
-insert_sql = f"""/*the insert part*/
-                INSERT INTO {dep.destination_table} (idmemo, changeddate, shortdescription, aiimproveddescription, aiparsedtopics, lastrundate, updatedate, source, aiparsedtopics2) 
-                SELECT idmemo, changeddate, shortdescription, aiimproveddescription, aiparsedtopics, lastrundate, updatedate, source, aiparsedtopics2 FROM pg_temp.stage_table 
+    finally: 
+        if cursor: 
+            cursor.close()
+        if conn:
+            conn.close()
+
+
+## ------ COPY BASED BATCH WRITER ------ ##
+destination_columns = ['idmemo', 'changeddate', 'shortdescription', 'aiimproveddescription', 'aiparsedtopics', 'lastrundate', 'updatedate', 'source', 'aiparsedtopics2', 'texthash']
+
+copy_stage_sql = f"""/*the temp table part, emptied again by every commit*/
+                CREATE TEMPORARY TABLE IF NOT EXISTS copy_stage_table (LIKE {dep.destination_table}) ON COMMIT DELETE ROWS
+            """
+copy_sql = f"COPY copy_stage_table ({', '.join(destination_columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+copy_insert_sql = f"""/*the insert part*/
+                INSERT INTO {dep.destination_table} (idmemo, changeddate, shortdescription, aiimproveddescription, aiparsedtopics, lastrundate, updatedate, source, aiparsedtopics2, texthash) 
+                SELECT idmemo, changeddate, shortdescription, aiimproveddescription, aiparsedtopics, lastrundate, updatedate, source, aiparsedtopics2, texthash FROM pg_temp.copy_stage_table 
                 ON CONFLICT (idmemo) DO UPDATE SET 
                     changeddate = EXCLUDED.changeddate,
                     shortdescription = EXCLUDED.shortdescription,
@@ -90,11 +107,68 @@ insert_sql = f"""/*the insert part*/
                     lastrundate = EXCLUDED.lastrundate,
                     updatedate = EXCLUDED.updatedate,
                     source = EXCLUDED.source,
-                    aiparsedtopics2 = EXCLUDED.aiparsedtopics2;
+                    aiparsedtopics2 = EXCLUDED.aiparsedtopics2,
+                    texthash = EXCLUDED.texthash;
             """
 
-def writeToDatabase(df) -> None:
-    with engine.begin() as conn:
-        conn.exec_driver_sql(stage_sql)
-        df.to_sql("stage_table", con=conn, if_exists="append", index=False)
-        conn.exec_driver_sql(insert_sql)
\ No newline at end of file
+@contextmanager
+def pooledConnection():
+    #Raw psycopg2 connection (COPY, server-side cursors) from the shared engine's pool, returned to the pool afterwards
+    conn = runtime.shared_context.dbEngine().raw_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def toPgArray(values):
+    #Postgres array literal for the text[] column, e.g. ['Cargo', 'Failure to warn'] -> {"Cargo","Failure to warn"}
+    if not isinstance(values, list): return None
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"') for value in values]
+    return '{' + ','.join(f'"{value}"' for value in escaped) + '}'
+
+def writeBatchToDatabase(df) -> None:
+    if df.empty: return
+    start_time = time.perf_counter()
+
+    batch_df = df.reindex(columns=destination_columns)
+    batch_df['aiparsedtopics'] = batch_df['aiparsedtopics'].map(toPgArray)
+    buffer = io.StringIO()
+    batch_df.to_csv(buffer, index=False, header=False, na_rep='\\N') #\N marks NULL, so empty strings stay empty strings
+    buffer.seek(0)
+
+    with pooledConnection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(copy_stage_sql)
+                cursor.copy_expert(copy_sql, buffer)
+                cursor.execute(copy_insert_sql)
+            conn.commit()
+        except (Exception, sql.DatabaseError) as e:
+            conn.rollback()
+            logger.critical(f'Failed to write batch to the database, with following error: {e}')
+            raise
+
+    elapsed = time.perf_counter() - start_time
+    logger.info(f'Wrote {len(batch_df)} rows to {dep.destination_table} in {elapsed:.2f}s ({len(batch_df) / elapsed:.0f} rows/sec)')
+
+
+## ------ CHANGE DETECTION ------ ##
+def refreshUnchangedRows():
+    #One bulk UPDATE for rows with a newer changeddate but the same text hash, run before the read so only rows with changed text are selected
+    with pooledConnection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(dep.texthash_exists_sql)
+                if cursor.fetchone() is None:
+                    logger.info(f'Adding the texthash column to {dep.destination_table}')
+                    cursor.execute(dep.texthash_column_sql)
+                cursor.execute(dep.refresh_unchanged_sql)
+                refreshed_rows = cursor.rowcount
+            conn.commit()
+        except (Exception, sql.DatabaseError) as e:
+            conn.rollback()
+            logger.critical(f'Failed to refresh unchanged rows, with following error: {e}')
+            raise
+
+    logger.info(f'{refreshed_rows} rows with unchanged text only got lastrundate/changeddate refreshed')
+    return refreshed_rows
@@ -1,6 +1,6 @@
 #################################################### OVERVIEW (START) ####################################################
-# LAST CHANGES [AUTHOR]: Erlend Skinnemoen
-# LAST CHANGES [DATE]: 29.02.2024
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
 #
 # DESCRIPTION 
 # The dependencies.py file is a key component of the microservice and acts at the interaction point with the user, providing essential utilities for the AI model integration, database interaction, and error handling. 
@@ -8,36 +8,95 @@
 # This file is crucial for connecting different parts of the system and maintaining efficient processing of safety reports.
 #################################################### OVERVIEW (END) ######################################################
 
+import hashlib
 import logging 
-import numpy as np
 import os
-import pandas as pd
 import sys
 
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, AzureOpenAI
 from types import TracebackType
 
 ## ------ VARIABLES ------ ##
 chunk_size = 200 # size for each chunk to be processed 
-num_workers = 4 
+num_workers = 4 # starting number of in-flight model requests, adjusted at runtime when adaptive_concurrency is on
 max_tries = 5
+requests_per_minute = 300 # RPM quota of the Azure OpenAI deployment, shared by all workers (see rate_limiter.py)
+tokens_per_minute = 50000 # TPM quota of the Azure OpenAI deployment, shared by all workers (see rate_limiter.py)
 engine = 'gpt-35-turbo' #as long as both parts of the script uses the same model 
-
-load_dotenv(dotenv_path='../.env') #make sure the path is correct 
+pipeline_mode = 'threaded' # 'threaded' (improve all rows, then parse) or 'async' (rows flow into parsing as soon as they are improved)
+cache_enabled = True # reuse earlier AI responses for identical prompt + input text (see response_cache.py)
+cache_path = './cache/llm_responses.sqlite'
+cache_max_bytes = 512 * 1024 * 1024 # least recently used responses are evicted above this size
+stream_mode = False # read the backlog in batches through a server-side cursor instead of loading it all at once
+stream_batch_size = 1000 # rows per batch that is processed, exported and written together (streamed from the server with --stream)
+journal_path = './checkpoint_journal.jsonl' # completed results of the current run, replayed by main.py --resume
+parse_batch_size = 1 # reports per topic parsing request, 1 sends one request per report (see parsing_topics_gpt_35_turbo.py)
+parse_batch_token_budget = 4000 # max estimated prompt + completion tokens of one batched parse request
+parse_batch_tokens_per_report = 60 # completion tokens reserved per report in a batched parse request
+parse_batch_wait = 0.5 # seconds the async pipeline waits for more improved rows to fill a parse batch
+preclassify_enabled = False # assign topics locally when the offline pre-classifier is confident (see topic_preclassifier.py)
+preclassify_threshold = 0.6 # min coverage (IDF-weighted share of a category's words found in the report) for a local assignment, higher sends more reports to the model. Measured on 28 hand-labelled reports: 0.6 kept 18 local, all with the right first topic; 0.5 also matched on single words ('poor' -> Poor housekeeping)
+preclassify_audit_rate = 0.05 # share of locally classified reports still sent to the model to measure agreement
+preclassify_hash_dim = 16384 # hashed bag-of-words vector size, a bucket shared by a report word and a category word counts as a match, so kept well above the vocabulary
+run_report_path = './run_report.json' # machine-readable per-stage timings, latencies, tokens and retries of the last run (see run_metrics.py)
+prometheus_textfile_path = None # e.g. '/var/lib/node_exporter/textfile/safetyai.prom' to also export the run report as Prometheus metrics
+improve_concurrency = 4 # max in-flight improve requests in the async pipeline, also with adaptive_concurrency on (the controller can only hold it lower)
+parse_concurrency = 4 # max in-flight parse requests in the async pipeline, also with adaptive_concurrency on
+adaptive_concurrency = True # grow/shrink the number of in-flight model requests from latency, 429s and timeouts (see adaptive_concurrency.py)
+concurrency_min = 1
+concurrency_max = 32 # also the number of worker threads per stage of the threaded pipeline pulling from the shared work queue
+concurrency_decrease_factor = 0.5 # limit multiplier on a 429 or timeout
+concurrency_latency_tolerance = 2.0 # only grow while the average latency is below this multiple of the best latency seen
+concurrency_max_error_rate = 0.05 # only grow while fewer than this share of recent calls were throttled or timed out
+dedup_enabled = False # send one representative per cluster of near-identical descriptions to the model (see near_duplicates.py)
+dedup_threshold = 0.8 # min estimated Jaccard similarity of word shingles for two reports to share results
+dedup_num_perm = 128 # MinHash signature length
+dedup_bands = 16 # LSH bands, dedup_num_perm / dedup_bands signature values per band
+dedup_shingle_size = 3 # words per shingle
+shard_processes = 2 # worker processes per pod in sharded mode (main.py --shards), each with its own clients and DB connections
+shard_lease_seconds = 900 # a claimed shard is handed to another worker if its lease is not renewed within this time (see sharded_runner.py)
+export_path = 'parsed_Text.parquet' # audit export of every processed row, one row group per batch (see parquet_export.py)
+parquet_compression = 'zstd' # compression of the Parquet export
+output_tag = '' # suffix for the export, journal and run report files, set per worker in sharded mode
+failure_queue_path = './cache/failure_queue.sqlite' # retry queue and dead-letter table of rows the AI steps could not process (see failure_queue.py)
+failure_max_replays = 3 # a transient failure that still fails after this many replays is moved to the dead-letter table
+tokenizer_encoding = 'cl100k_base' # BPE encoding of the engine, used to count tokens locally (see token_budget.py)
+tokenizer_dir = './tokenizer' # local copy of the tokenizer file, fetched once with python token_budget.py --download
+improve_chunk_tokens = 300 # longer descriptions are split at sentence boundaries and improved chunk by chunk, small enough for the improved chunk to fit in improve_max_tokens
+improve_max_chunks = 8 # text beyond this many chunks is not sent to the model
+improve_max_tokens = 500 # completion limit of an improve request, shorter inputs get proportionally less
+parse_max_input_tokens = 1000 # longer improved texts are trimmed at a sentence boundary before topic parsing
+parse_max_tokens = 100 # completion limit of a parse request, fixed since the answer is up to six category names (~70 tokens for the six longest)
+
+http_max_connections = 32 # keep-alive connection pool shared by every Azure OpenAI request of a process, at least concurrency_max (see runtime_context.py)
+http_keepalive_expiry = 60 # seconds an idle connection is kept open for the next request
+db_pool_recycle = 1800 # seconds before a pooled DB connection is replaced
 
 logger = logging.getLogger(__name__)
 
+## ------ ENVIRONMENT ------ ## 
+environment_loaded = False
+
+def loadEnvironment():
+    #.env is read once, by whatever needs it first (logging setup, Azure OpenAI client or DB connection), never at import
+    global environment_loaded
+    if not environment_loaded:
+        load_dotenv(dotenv_path='../.env') #make sure the path is correct 
+        environment_loaded = True
+
 
 ## ------ DATABASE INTERACTION ------ ## 
 input_table = ''
 destination_table = ''
-select_columns = f'INPUT_DATA_TABLE.idmemo,  INPUT_DATA_TABLE.changeddate, INPUT_DATA_TABLE._value,  AI_RESULTS_TABLE.updatedate , INPUT_DATA_TABLE.template_name'
+db_pool_size = 4 # pooled connections of the shared DB engine used by every read and write (see runtime_context.py)
+lease_table = '' # shard lease table for main.py --shards, defaults to <destination_table>_shard_leases
+
+def databaseSettings():
+    loadEnvironment()
+    return {'host': os.environ["DB_HOST"], 'dbname': os.environ["DB_HOST_NAME"], 'user': os.environ["DB_USERNAME"], 'password': os.environ["DB_USER_PWD"], 'port': os.environ["DB_PORT_ID"]}
 
-SELECT_sql_script = f"""SELECT {select_columns} FROM {input_table} AS INPUT_DATA_TABLE
-                        LEFT JOIN {destination_table} AS AI_RESULTS_TABLE ON INPUT_DATA_TABLE.idmemo = AI_RESULTS_TABLE.idmemo
-                        WHERE (INPUT_DATA_TABLE.itemname ILIKE '%descri%' AND (AI_RESULTS_TABLE.idmemo IS NULL OR (INPUT_DATA_TABLE.changeddate > AI_RESULTS_TABLE.changeddate OR AI_RESULTS_TABLE.changeddate IS NULL)) )
-""" 
+select_columns = f'INPUT_DATA_TABLE.idmemo,  INPUT_DATA_TABLE.changeddate, INPUT_DATA_TABLE._value,  AI_RESULTS_TABLE.updatedate , INPUT_DATA_TABLE.template_name'
 
 ## ------ PROMPTS ------ ##  
 promt_improvedText = (
@@ -48,23 +107,73 @@ promt_improvedText = (
             "The text should be formal and concise."
 )
 
-topic_categ = np.genfromtxt("./categories.txt", dtype=str, delimiter='\n') #IMPORTANT FILE WITH PRE-ARRANGED TOPICS - UPDATE IF TOPICS In KFLEET CHANGES 
-topic_categ_str = ', '.join(topic_categ)    
-
-promt_parseText = (
-            "You will be provided with a text. Based on the text, list up to six elements that are most relevant to the safety of personnel and materials. "
-            f"The elements should be selected from the provided list: {topic_categ_str}. Write the elements in plain text, separated by commas without any leading characters such as dashes or bullets. "
-            "Do not add any explanatory information, do not restate any parts of the original text, and do not create new elements. Use only the exact terms provided."
-        )
+categories_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'categories.txt') #IMPORTANT FILE WITH PRE-ARRANGED TOPICS - UPDATE IF TOPICS In KFLEET CHANGES 
+
+def loadCategories():
+    with open(categories_path, encoding='utf-8') as categories_file:
+        return [line.strip() for line in categories_file if line.strip()]
+
+def parsePrompts():
+    topic_categ = loadCategories()
+    topic_categ_str = ', '.join(topic_categ)    
+
+    promt_parseText = (
+                "You will be provided with a text. Based on the text, list up to six elements that are most relevant to the safety of personnel and materials. "
+                f"The elements should be selected from the provided list: {topic_categ_str}. Write the elements in plain text, separated by commas without any leading characters such as dashes or bullets. "
+                "Do not add any explanatory information, do not restate any parts of the original text, and do not create new elements. Use only the exact terms provided."
+            )
+
+    promt_parseTextBatch = (
+                "You will be provided with a JSON object that maps report ids to report texts. For each report, list up to six elements that are most relevant to the safety of personnel and materials. "
+                f"The elements should be selected from the provided list: {topic_categ_str}. "
+                "Respond only with a JSON object that maps every report id to a JSON list of the selected elements, as plain strings. "
+                "Do not add any explanatory information, do not restate any parts of the original texts, and do not create new elements. Use only the exact terms provided."
+            )
+    return {'topic_categ': topic_categ, 'topic_categ_str': topic_categ_str, 'promt_parseText': promt_parseText, 'promt_parseTextBatch': promt_parseTextBatch}
+
+## ------ CHANGE DETECTION ------ ##
+#Rows whose normalized text (and prompts/categories) are unchanged since the last run only get lastrundate/changeddate bumped, they never reach the model
+def changeDetectionSql():
+    content_version = hashlib.sha256('\x00'.join([engine, promt_improvedText, lazySetting('promt_parseText'), lazySetting('promt_parseTextBatch')]).encode('utf-8')).hexdigest()[:16] #changes with the prompts and categories.txt
+    texthash_sql = f"md5(lower(regexp_replace(btrim(coalesce(INPUT_DATA_TABLE._value, '')), '\\s+', ' ', 'g')) || '|{content_version}')"
+
+    SELECT_sql_script = f"""SELECT {select_columns}, {texthash_sql} AS texthash FROM {input_table} AS INPUT_DATA_TABLE
+                            LEFT JOIN {destination_table} AS AI_RESULTS_TABLE ON INPUT_DATA_TABLE.idmemo = AI_RESULTS_TABLE.idmemo
+                            WHERE (INPUT_DATA_TABLE.itemname ILIKE '%descri%' AND (AI_RESULTS_TABLE.idmemo IS NULL OR ((INPUT_DATA_TABLE.changeddate > AI_RESULTS_TABLE.changeddate OR AI_RESULTS_TABLE.changeddate IS NULL) AND AI_RESULTS_TABLE.texthash IS DISTINCT FROM {texthash_sql})) )
+    """ 
+
+    #One-time migration: the ALTER takes an ACCESS EXCLUSIVE lock even when the column exists, so it only runs when the catalog lookup finds no texthash column
+    texthash_exists_sql = f"SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass('{destination_table}') AND attname = 'texthash' AND NOT attisdropped"
+    texthash_column_sql = f"ALTER TABLE {destination_table} ADD COLUMN IF NOT EXISTS texthash TEXT" #rows written before this column existed get their hash the next time they are processed
+
+    refresh_unchanged_sql = f"""UPDATE {destination_table} AS AI_RESULTS_TABLE
+                            SET lastrundate = date_trunc('second', LOCALTIMESTAMP), changeddate = INPUT_DATA_TABLE.changeddate
+                            FROM {input_table} AS INPUT_DATA_TABLE
+                            WHERE INPUT_DATA_TABLE.idmemo = AI_RESULTS_TABLE.idmemo AND INPUT_DATA_TABLE.itemname ILIKE '%descri%'
+                                AND (INPUT_DATA_TABLE.changeddate > AI_RESULTS_TABLE.changeddate OR AI_RESULTS_TABLE.changeddate IS NULL)
+                                AND AI_RESULTS_TABLE.texthash = {texthash_sql}
+    """
+    return {'content_version': content_version, 'texthash_sql': texthash_sql, 'SELECT_sql_script': SELECT_sql_script, 'texthash_exists_sql': texthash_exists_sql, 'texthash_column_sql': texthash_column_sql, 'refresh_unchanged_sql': refresh_unchanged_sql}
+
+## ------ LAZY SETTINGS ------ ## 
+#Built on the first access of dep.<name> instead of at import, so importing this module never reads categories.txt. Assigning one of them before first use overrides it
+lazy_settings = {}
+for builder, names in ((parsePrompts, ('topic_categ', 'topic_categ_str', 'promt_parseText', 'promt_parseTextBatch')),
+                       (changeDetectionSql, ('content_version', 'texthash_sql', 'SELECT_sql_script', 'texthash_exists_sql', 'texthash_column_sql', 'refresh_unchanged_sql'))):
+    lazy_settings.update(dict.fromkeys(names, builder))
+
+def lazySetting(name):
+    if name not in globals():
+        for setting_name, value in lazy_settings[name]().items():
+            globals().setdefault(setting_name, value)
+    return globals()[name]
+
+def __getattr__(name):
+    if name not in lazy_settings: raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return lazySetting(name)
 
 ## ------ ERROR CATCHING ------ ## 
-improved_failed_rows = []  # List to store failed rows from improve_text_gpt_35_turbo.py 
-parsed_failed_rows = [] # List to store failed rows from parsing_topics_gpt_35_turbo.py
-
-def storeFailuresToCsv(failed_rows, file_name):
-    failed_rows_df = pd.DataFrame(failed_rows).drop_duplicates(subset=['idmemo'])
-    if not failed_rows_df.empty:
-        failed_rows_df.to_csv(f'{file_name}_failedRows.csv', index=False) #seperate file for imporved_Text and parsed_topics
+#Rows that fail in the AI steps are recorded by idmemo in failure_queue.py: transient failures are replayed with main.py --replay, permanent ones go to the dead-letter table
 
 #Central Exception handling: This functions simply hooks the sys.excepthook. For detailed information see the docs for sys.excepthook.
 def handle_exception(
@@ -80,11 +189,25 @@ def handle_exception(
     )  # type: ignore
 
 ## ------ AZURE AI AUTHENTICATION ------ ##  
-def client():
+#Called once per process by runtime_context.py, with the shared keep-alive httpx client
+def client(http_client=None):
+    loadEnvironment()
     client = AzureOpenAI(
         api_key = os.environ["AZURE_OPENAI_API_KEY"],
         azure_endpoint= os.environ["AZURE_OPENAI_ENDPOINT"],
-        api_version= "2024-02-15-preview")
+        api_version= "2024-02-15-preview",
+        http_client = http_client,
+        max_retries = 0) # model_request.py owns the retries, so the rate limiter, adaptive concurrency and the failure queue see every 429/timeout
     return client
 
-                
\ No newline at end of file
+                
+
+def async_client(http_client=None):
+    loadEnvironment()
+    async_client = AsyncAzureOpenAI(
+        api_key = os.environ["AZURE_OPENAI_API_KEY"],
+        azure_endpoint= os.environ["AZURE_OPENAI_ENDPOINT"],
+        api_version= "2024-02-15-preview",
+        http_client = http_client,
+        max_retries = 0) # see client()
+    return async_client
@@ -0,0 +1,123 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Durable record of the rows the AI steps could not process, kept in a local SQLite file (dep.failure_queue_path) with only the idmemo, the step and the reason.
+# Errors are classified when they happen: transient ones (timeouts, connection errors, 429s, 5xx) that are still failing after dep.max_tries go to the retry queue,
+# permanent ones (BadRequestError, e.g. the Azure content filter) go straight to the dead-letter table without any retries, since they fail the same way every time.
+# python main.py --replay reprocesses only the pending transient failures; a row that keeps failing is moved to the dead-letter table after dep.failure_max_replays replays.
+#################################################### OVERVIEW (END) ######################################################
+
+import dependencies as dep
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from collections import defaultdict
+from openai import BadRequestError
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def classifyError(error):
+    #Everything model_request.isTransient retries (e.g. 408/409/429/5xx) is transient, only rejected requests are permanent
+    return 'permanent' if isinstance(error, BadRequestError) else 'transient'
+
+def errorReason(error):
+    return f'{type(error).__name__}: {error}'[:500]
+
+
+class FailureQueue:
+    def __init__(self, path, max_replays):
+        self.path = path
+        self.max_replays = max_replays
+        self.conn = None
+        self.counts = defaultdict(int) # failures recorded by this run, per (stage, classification)
+        self.run_failures = {} # idmemo -> (stage, classification, reason) of the failures recorded by this process, for the members of a failed near-duplicate representative. No exception objects, they hold the request with the report text
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        #Opened on first use, so a run without failures never creates the file
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30) # the workers of a sharded run share the file
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS retry_queue (idmemo TEXT NOT NULL, stage TEXT NOT NULL, reason TEXT, attempts INTEGER NOT NULL,
+                                 status TEXT NOT NULL, last_failed REAL NOT NULL, PRIMARY KEY (idmemo, stage))""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS dead_letter (idmemo TEXT NOT NULL, stage TEXT NOT NULL, reason TEXT, attempts INTEGER NOT NULL,
+                                 failed_at REAL NOT NULL, PRIMARY KEY (idmemo, stage))""")
+        return self.conn
+
+    def record(self, stage, row, error=None, classification=None, reason=None):
+        #Takes the error itself, or the classification and reason of an earlier failure (a near-duplicate member sharing its representative's failure)
+        idmemo = str(row['idmemo'])
+        if error is not None:
+            classification, reason = classifyError(error), errorReason(error)
+        failure = (stage, classification, reason)
+        with self.lock:
+            conn = self._connect()
+            previous = conn.execute("SELECT attempts FROM retry_queue WHERE idmemo = ? AND stage = ?", (idmemo, stage)).fetchone()
+            attempts = (previous[0] if previous else 0) + 1
+            if classification == 'transient' and attempts <= self.max_replays:
+                conn.execute("INSERT OR REPLACE INTO retry_queue (idmemo, stage, reason, attempts, status, last_failed) VALUES (?, ?, ?, ?, 'pending', ?)",
+                             (idmemo, stage, reason, attempts, time.time()))
+            else:
+                if classification == 'transient':
+                    reason = f'Gave up after {attempts - 1} replays. {reason}'
+                conn.execute("DELETE FROM retry_queue WHERE idmemo = ? AND stage = ?", (idmemo, stage))
+                conn.execute("INSERT OR REPLACE INTO dead_letter (idmemo, stage, reason, attempts, failed_at) VALUES (?, ?, ?, ?, ?)",
+                             (idmemo, stage, reason, attempts, time.time()))
+            self.counts[(stage, classification)] += 1
+            self.run_failures.setdefault(idmemo, failure) # the first failing stage, a failed improve also fails its parse
+
+    def takePending(self):
+        #Marks every pending transient failure as being replayed and returns their idmemos.
+        #Rows still 'replaying' belong to a replay that crashed before finishReplay(), they are taken again instead of staying stuck
+        with self.lock:
+            conn = self._connect()
+            stale = conn.execute("SELECT COUNT(*) FROM retry_queue WHERE status = 'replaying'").fetchone()[0]
+            if stale:
+                logger.warning(f'{stale} failures were left by an interrupted replay, replaying them again')
+            idmemos = sorted({idmemo for (idmemo,) in conn.execute("SELECT idmemo FROM retry_queue WHERE status IN ('pending', 'replaying')")})
+            conn.execute("UPDATE retry_queue SET status = 'replaying' WHERE status = 'pending'")
+        return idmemos
+
+    def finishReplay(self):
+        #Rows that failed again were set back to pending by record(), the rest succeeded
+        with self.lock:
+            resolved = self._connect().execute("DELETE FROM retry_queue WHERE status = 'replaying'").rowcount
+        logger.info(f'Replay resolved {resolved} failures')
+        return resolved
+
+    def failureOf(self, idmemo):
+        #Returns (stage, classification, reason) when the row failed in this process, otherwise None
+        with self.lock:
+            return self.run_failures.get(str(idmemo))
+
+    def failedCount(self, stage):
+        with self.lock:
+            return sum(count for (failed_stage, _), count in self.counts.items() if failed_stage == stage)
+
+    def stats(self):
+        with self.lock:
+            return {f'{stage}_{classification}': count for (stage, classification), count in sorted(self.counts.items())}
+
+    def logStats(self):
+        if not self.counts: return
+        stats = ', '.join(f'{name}: {count}' for name, count in self.stats().items())
+        logger.info(f'Failures of this run ({stats}) recorded in {self.path}, run main.py --replay to reprocess the transient ones')
+
+
+def replaySelect(idmemos):
+    #Unlike SELECT_sql_script this does not skip rows that already have results, the failed rows were written with empty results
+    idmemo_list = ', '.join("'" + str(idmemo).replace("'", "''") + "'" for idmemo in idmemos)
+    return f"""SELECT {dep.select_columns}, {dep.texthash_sql} AS texthash FROM {dep.input_table} AS INPUT_DATA_TABLE
+                LEFT JOIN {dep.destination_table} AS AI_RESULTS_TABLE ON INPUT_DATA_TABLE.idmemo = AI_RESULTS_TABLE.idmemo
+                WHERE INPUT_DATA_TABLE.itemname ILIKE '%descri%' AND INPUT_DATA_TABLE.idmemo::text IN ({idmemo_list})
+            """
+
+
+shared_queue = FailureQueue(dep.failure_queue_path, dep.failure_max_replays)
@@ -1,30 +1,26 @@
 #################################################### OVERVIEW (START) ####################################################
-# LAST CHANGES [AUTHOR]: Erlend Skinnemoen
-# LAST CHANGES [DATE]: 29.02.2024
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
 #
 # DESCRIPTION 
 # First step in the AI process and focuses on iporving the free-text descriptions from the Improvment Reports from Kongsberg Maritime KFLEET.
-# It processes each report row by row, applying improvements to the text for better readability and understanding. The script handles errors, retrying when possible and logging failures without stopping the entire process. 
-# Results are aggregated and sorted for further use, ensuring that the enhanced text aligns with the original report's sequence.
+# It processes each report row by row, applying improvements to the text for better readability and understanding. The script handles errors, retrying when possible and logging failures without stopping the entire process (see model_request.py). 
+# Descriptions above the token budget are split at sentence boundaries and improved chunk by chunk (see token_budget.py).
+# Results are aggregated by row index for further use, ensuring that the enhanced text aligns with the original report's sequence.
 #################################################### OVERVIEW (END) ######################################################
 
+import checkpoint_journal as journal
 import dependencies as dep
 import logging
+import model_request as modelReq
 import pandas as pd
-import random
-import requests
-import time 
+import response_cache as respCache
+import token_budget as tokBudget
 
-from azure.core.exceptions import HttpResponseError, ServiceRequestError
 from concurrent.futures import as_completed
-from openai import BadRequestError
-
-## ------ VARIABLES ------ ##
-improved_text = [] # List to store results
 
 ## ------ FUNCTIONS ------ ##
 logger = logging.getLogger(__name__)
-azure_client = dep.client()
 
 def extractResponse(response):
     try: 
@@ -36,62 +32,87 @@ def extractResponse(response):
     except Exception as e:
         logger.error("Error extracting content from response: %s", e)
 
+def improveMessages(text):
+    return [
+        {
+            "role": "system",
+            "content": dep.promt_improvedText
+        },
+        {
+            "role": "user",
+            "content": f"Original text: {text}"
+        }
+    ]
+
+def requestImprovedText(row, text):
+    #One improve request with retries (see model_request.py) for the description or one chunk of it. Returns (succeeded, improved text)
+    messages = improveMessages(text)
+    max_tokens = tokBudget.shared_budget.improveMaxTokens(text)
+    response, error = modelReq.requestCompletion('improve', [row], messages, max_tokens, temperature=0.7, n=1, stop=None)
+    if response is None: return False, ""
+    return True, extractResponse(response)
+
+def joinImprovedChunks(improved_chunks):
+    return improved_chunks[0] if len(improved_chunks) == 1 else '\n'.join(chunk for chunk in improved_chunks if chunk)
+
 def aiImprovedResponse(row):
     text = row['_value']
-    if pd.isnull(text): improved_text = ""
-    else:    
-        for retry in range(dep.max_tries):
-            time.sleep(1) # due to token rate limit
-            try: 
-                response = azure_client.chat.completions.create(
-                    model = dep.engine, 
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": dep.promt_improvedText
-                        },
-                        {
-                            "role": "user",
-                            "content": f"Original text: {text}"
-                        }
-                    ],
-                max_tokens=500,
-                temperature=0.7,
-                n=1,
-                stop=None,
-                )
-                improved_text = extractResponse(response)
-
-
-            except(HttpResponseError, ServiceRequestError, requests.exceptions.ReadTimeout) as e:                   
-                logger.error(f"Error type encountered: {e}")
-                if retry < dep.max_tries - 1:
-                    backoff_time = (2 ** retry) + random.random() # Exponential backoff with jitter
-                    logger.warning(f"Retrying in {backoff_time} seconds, number of retries {retry}")
-                    time.sleep(backoff_time)
-                else:
-                    logger.error(f"Max retries exceeded. Skipping this row: {row['idmemo']}.") 
-                    dep.improved_failed_rows.append(row)
-                    improved_text = ""
-            except(BadRequestError) as e:
-                if retry < dep.max_tries - 1:
-                    backoff_time = (2 ** retry) + random.random() # Exponential backoff with jitter
-                    logger.warning(f"Error type: {e}.\nRetrying in {backoff_time} seconds, number of retries {retry}")
-                    time.sleep(backoff_time)
-                else: 
-                    logger.error(f"Error type {e} \nYour request was not accepted due to content policy violations (AZURE/OpenAI). Skipping this row: {row['idmemo']}.") 
-                    dep.improved_failed_rows.append(row)
-                    improved_text = ""
+    if pd.isnull(text):
+        journal.shared_journal.record('improve', row, "")
+        return row.name, ""
+
+    cache_key = respCache.shared_cache.key(dep.engine, dep.promt_improvedText, 0.7, text)
+    improved_text = respCache.shared_cache.get(cache_key)
+    if improved_text is None:
+        #Long descriptions are improved chunk by chunk (see token_budget.py), one failed chunk fails the row
+        improved_chunks = []
+        for chunk in tokBudget.shared_budget.improveChunks(text):
+            succeeded, improved_chunk = requestImprovedText(row, chunk)
+            if not succeeded: return row.name, ""
+            improved_chunks.append(improved_chunk)
+        improved_text = joinImprovedChunks(improved_chunks)
+        respCache.shared_cache.put(cache_key, improved_text)
 
+    journal.shared_journal.record('improve', row, improved_text)
     return row.name, improved_text
 
 
-def aggregateTextResults(futures):
-    for future in as_completed(futures): #combining result 
-        improved_text.extend(future.result())
+async def requestImprovedTextAsync(client, row, text):
+    #Same as requestImprovedText, but awaits the AsyncAzureOpenAI client instead of blocking a thread
+    messages = improveMessages(text)
+    max_tokens = tokBudget.shared_budget.improveMaxTokens(text)
+    response, error = await modelReq.requestCompletionAsync(client, 'improve', [row], messages, max_tokens, temperature=0.7, n=1, stop=None)
+    if response is None: return False, ""
+    return True, extractResponse(response)
+
+async def aiImprovedResponseAsync(client, row):
+    #Same chunking/cache/failure semantics as aiImprovedResponse
+    text = row['_value']
+    if pd.isnull(text):
+        journal.shared_journal.record('improve', row, "")
+        return row.name, ""
+
+    cache_key = respCache.shared_cache.key(dep.engine, dep.promt_improvedText, 0.7, text)
+    improved_text = respCache.shared_cache.get(cache_key)
+    if improved_text is None:
+        improved_chunks = []
+        for chunk in tokBudget.shared_budget.improveChunks(text):
+            succeeded, improved_chunk = await requestImprovedTextAsync(client, row, chunk)
+            if not succeeded: return row.name, ""
+            improved_chunks.append(improved_chunk)
+        improved_text = joinImprovedChunks(improved_chunks)
+        respCache.shared_cache.put(cache_key, improved_text)
+
+    journal.shared_journal.record('improve', row, improved_text)
+    return row.name, improved_text
 
-    improved_text.sort(key=lambda x: x[0]) #Sort by row index 
-    improved_text_data = [text for _, text in improved_text]
-    return improved_text_data
 
+def aggregateTextResults(futures):
+    #Combining results column-wise into a Series keyed by row index, ready for one aligned assignment into the dataframe
+    row_indexes, improved_text = [], []
+    for future in as_completed(futures):
+        row_index, text = future.result()
+        row_indexes.append(row_index)
+        improved_text.append(text)
 
+    return pd.Series(improved_text, index=row_indexes, dtype=object)
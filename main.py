@@ -1,31 +1,45 @@
 #################################################### OVERVIEW (START) ####################################################
-# LAST CHANGES [AUTHOR]: Erlend Skinnemoen
-# LAST CHANGES [DATE]: 29.02.2024
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
 #
 # DESCRIPTION 
 # The script orchestrates the processing of the service through a series of steps including reading data from a database, enhancing text clarity using an AI model, categorizing report topics, and updating the database with processed information. 
 # It utilizes concurrent processing for efficiency and logs each step for transparency. 
 #
 # DATAFLOW: Database -[READ]-> improve_text_gpt_35_turbo.py -[dataframe]-> parsing_topics_gpt_35_turbo -[WRITE]-> Database
+# -- With --pipeline async the two AI steps are overlapped per row by async_pipeline.py instead of running one after the other
 # -- In addition, the dependencies.py acts as a supporting module and interacts with all .py files
 #################################################### OVERVIEW (END) ######################################################
 
+import adaptive_concurrency as adaptConc
+import async_pipeline as asyncPipe
+import checkpoint_journal as journal
 import database_connection as dbConn
+import failure_queue as failQueue
 import improve_text_gpt_35_turbo as imprText
+import near_duplicates as nearDup
+import parquet_export as pqExport
 import parsing_topics_gpt_35_turbo as parsTop
 import dependencies as dep
+import response_cache as respCache
+import run_metrics as runMetrics
+import runtime_context as runtime
+import sharded_runner as shardRun
+import token_budget as tokBudget
+import topic_preclassifier as preClass
 
+import argparse
 import logging
-import numpy as np
 import os 
+import pandas as pd
 import sys
-import time
 
 from concurrent.futures import ThreadPoolExecutor
 
 ## ------ LOGGING ------ ## 
 def configure_logging() -> None:
    """Configure logging."""
+   dep.loadEnvironment()
    fmt = '%(asctime)s %(lineno)-4s%(funcName)-20s %(levelname)-8s %(message)s'
    log_level = os.environ["LOG_LEVEL"]
    level = getattr(logging, log_level, logging.INFO)
@@ -37,48 +51,211 @@ def configure_logging() -> None:
    return logging.getLogger(__name__)
 
 
-def main():
-    __logger = configure_logging()
-    __logger.info('Logging is set up, script has started')
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='AI improvement and topic parsing of improvement reports')
+    parser.add_argument('--pipeline', choices=['threaded', 'async'], default=dep.pipeline_mode,
+                        help='threaded: improve all rows, then parse all rows. async: parse each row as soon as its text is improved')
+    parser.add_argument('--stream', action='store_true', default=dep.stream_mode,
+                        help='read the backlog through a server-side cursor and process, export and write it in batches of dep.stream_batch_size rows')
+    parser.add_argument('--parse-batch-size', type=int, default=dep.parse_batch_size,
+                        help='number of reports packed into one topic parsing request (1 = one request per report)')
+    parser.add_argument('--preclassify', action='store_true', default=dep.preclassify_enabled,
+                        help='assign topics with the offline pre-classifier when it is confident and only send ambiguous reports to the model')
+    parser.add_argument('--dedup', action='store_true', default=dep.dedup_enabled,
+                        help='send one representative per cluster of near-identical descriptions to the model and copy its results to the other members')
+    parser.add_argument('--resume', action='store_true',
+                        help='replay the checkpoint journal of an interrupted run and only send unfinished rows to the model')
+    parser.add_argument('--replay', action='store_true',
+                        help='only reprocess the pending transient failures of earlier runs from the failure queue')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='split the selected idmemo keyspace into this many hash shards, claimed through the lease table (0 = no sharding)')
+    parser.add_argument('--processes', type=int, default=dep.shard_processes,
+                        help='worker processes of this pod that claim shards, only with --shards')
+    parser.add_argument('--run-id',
+                        help='identifies one sharded run, every pod started with the same run id shares its shards (required with --shards)')
+    args = parser.parse_args(argv)
+    if args.shards and not args.run_id:
+        #No default: a date or other implicit id would let a second run on the same day silently join the completed first one
+        parser.error('--shards needs an explicit --run-id shared by every pod of the run')
+    return args
 
-    #Read from DB  
-    conn = dbConn.databaseConnection()
-    dataset_df = dbConn.readFromDatabase(conn, dep.SELECT_sql_script)
-    dataset_df = dataset_df.drop_duplicates(subset=['idmemo'])
 
-    #Improve text 
-    chunks = np.array_split(dataset_df, dep.num_workers)
-    with ThreadPoolExecutor(max_workers = dep.num_workers) as executor: 
-        futures = [executor.submit(chunk.apply, imprText.aiImprovedResponse, axis=1) for chunk in chunks]
+def runThreadedPipeline(dataset_df, __logger, parse_batch_size, preclassify):
+    #Improve text, rows resumed from the journal already carry their improved text
+    if 'aiimproveddescription' not in dataset_df:
+        dataset_df['aiimproveddescription'] = None
+    pending_df = dataset_df[dataset_df['aiimproveddescription'].isna()]
+
+    #One shared work queue of rows instead of one fixed chunk per thread, the adaptive controller decides how many of the workers call the model at once
+    with runMetrics.shared_metrics.stage('improve', len(pending_df)):
+        with ThreadPoolExecutor(max_workers = adaptConc.shared_controller.workerCount(dep.num_workers)) as executor: 
+            futures = [executor.submit(imprText.aiImprovedResponse, row) for _, row in pending_df.iterrows()]
     
-    improved_text_data = imprText.aggregateTextResults(futures)
-    dataset_df['aiimproveddescription'] = improved_text_data
-    dep.storeFailuresToCsv(dep.improved_failed_rows, 'improved_text')
+        improved_text_data = imprText.aggregateTextResults(futures)
+        dataset_df.loc[improved_text_data.index, 'aiimproveddescription'] = improved_text_data
 
-    __logger.info(f'Improved text finished with:\n Imporved text rows: {len(improved_text_data)} \n Failed rows: {len(dep.improved_failed_rows)}')
+    __logger.info(f'Improved text finished with:\n Imporved text rows: {len(improved_text_data)} \n Failed rows: {failQueue.shared_queue.failedCount("improve")}')
 
     #Parse text 
     for i in range(0, len(dataset_df), dep.chunk_size):
         chunk = dataset_df.iloc[i:i + dep.chunk_size]
-        with ThreadPoolExecutor(max_workers=dep.num_workers) as executor:
-            futures = [executor.submit(parsTop.aiTopicResponse, row) for _, row in chunk.iterrows()]
+        with runMetrics.shared_metrics.stage('parse', len(chunk)):
+            rows = [row for _, row in chunk.iterrows()]
+            audited = {}
+            if preclassify:
+                local_results, rows, audited = preClass.shared_preclassifier.split(rows)
+                parsTop.applyParseResults(dataset_df, local_results)
+
+            with ThreadPoolExecutor(max_workers=adaptConc.shared_controller.workerCount(dep.num_workers)) as executor:
+                if parse_batch_size > 1:
+                    batches = parsTop.splitParseBatches(rows, parse_batch_size, dep.parse_batch_token_budget)
+                    futures = [executor.submit(parsTop.aiTopicResponseBatch, batch) for batch in batches]
+                else:
+                    futures = [executor.submit(parsTop.aiTopicResponse, row) for row in rows]
+
+            parsTop.aggregateParseResponse(futures, dataset_df)
+            if audited:
+                preClass.shared_preclassifier.audit(audited, dataset_df.loc[list(audited), 'aiparsedtopics'].to_dict())
+            __logger.info(f"Processed chunk {i // dep.chunk_size + 1}/{(len(dataset_df) - 1) // dep.chunk_size + 1}")
+
+    return dataset_df
+
 
-        parsTop.aggregateParseResponse(futures, dataset_df)
-        __logger.info(f"Processed chunk {i // dep.chunk_size + 1}/{(len(dataset_df) - 1) // dep.chunk_size + 1}")
-        time.sleep(2) 
+def processBatch(dataset_df, args, __logger, completed, clusters=None):
+    #clusters: (members, representative_of) of a selection that was collapsed as a whole, the members of this batch's representatives are fanned out with it
+    done_df, dataset_df = journal.shared_journal.restoreRows(dataset_df, completed)
+    if clusters is not None:
+        members_df, representative_of = clusters
+        in_batch = representative_of.isin(done_df.index.union(dataset_df.index)).values
+        members_df, representative_of = members_df[in_batch], representative_of[in_batch]
+    elif args.dedup:
+        dataset_df, members_df, representative_of = nearDup.shared_detector.collapse(dataset_df)
+
+    #Improve and parse text 
+    if dataset_df.empty:
+        pass
+    elif args.pipeline == 'async':
+        with runMetrics.shared_metrics.stage('improve_parse', len(dataset_df)):
+            dataset_df = asyncPipe.runPipeline(dataset_df, args.parse_batch_size, args.preclassify)
+    else:
+        dataset_df = runThreadedPipeline(dataset_df, __logger, args.parse_batch_size, args.preclassify)
+    dataset_df = pd.concat([done_df, dataset_df]).sort_index()
+    if args.dedup:
+        dataset_df = nearDup.shared_detector.fanOut(dataset_df, members_df, representative_of) # a representative may also come from the journal
     
     #Formatting
-    new_col_order = ['idmemo', 'changeddate', 'shortdescription', 'aiimproveddescription', 'aiparsedtopics', 'lastrundate', 'updatedate', 'source', 'aiparsedtopics2']
+    new_col_order = ['idmemo', 'changeddate', 'shortdescription', 'aiimproveddescription', 'aiparsedtopics', 'lastrundate', 'updatedate', 'source', 'aiparsedtopics2', 'texthash']
     dataset_df.rename(columns={'_value':'shortdescription', 'template_name':'source'}, inplace = True)
-    dataset_df = dataset_df.reindex(columns = new_col_order)
-    
-    dep.storeFailuresToCsv(dep.parsed_failed_rows, 'parsed_topics')
-    dataset_df.to_csv('parsed_Text.csv', index=False)
+    return dataset_df.reindex(columns = new_col_order)
+
+
+def processSelection(conn, select_sql, args, __logger, completed):
+    #Reads, processes, exports and writes every row returned by select_sql in batches of dep.stream_batch_size. Returns the number of rows processed
+    #Each batch is written before the next one is processed, so a crash keeps the AI work of every finished batch
+    if args.stream:
+        #Batches come from the server-side cursor, the next one is only fetched once the previous one is written
+        batches = runMetrics.shared_metrics.timedIterator('db_read', dbConn.readFromDatabaseStream(conn, select_sql, dep.stream_batch_size))
+        clusters = None
+    else:
+        with runMetrics.shared_metrics.stage('db_read') as tracked:
+            selected_df = dbConn.readFromDatabase(conn, select_sql)
+            tracked['rows'] = len(selected_df)
+        selected_df = selected_df.drop_duplicates(subset=['idmemo'])
+        clusters = None
+        if args.dedup:
+            #The whole selection is in memory, so near-duplicates are found across batches and fanned out with their representative's batch
+            selected_df, members_df, representative_of = nearDup.shared_detector.collapse(selected_df)
+            clusters = (members_df, representative_of)
+        batches = (selected_df.iloc[i:i + dep.stream_batch_size] for i in range(0, len(selected_df), dep.stream_batch_size))
+
+    seen_idmemo = set()
+    processed_rows = 0
+    for batch_number, dataset_df in enumerate(batches):
+        dataset_df = dataset_df.drop_duplicates(subset=['idmemo'])
+        dataset_df = dataset_df[~dataset_df['idmemo'].isin(seen_idmemo)]
+        seen_idmemo.update(dataset_df['idmemo'])
+        if dataset_df.empty: continue
+
+        dataset_df = processBatch(dataset_df, args, __logger, completed, clusters)
+        with runMetrics.shared_metrics.stage('export', len(dataset_df)):
+            pqExport.shared_writer.write(dataset_df)
+        with runMetrics.shared_metrics.stage('db_write', len(dataset_df)):
+            dbConn.writeBatchToDatabase(dataset_df)
+        processed_rows += len(dataset_df)
+        __logger.info(f'Finished batch {batch_number + 1} ({processed_rows} rows so far)')
+    return processed_rows
+
+
+def finishRun(args):
+    journal.shared_journal.close()
+    pqExport.shared_writer.close()
+    respCache.shared_cache.logStats()
+    adaptConc.shared_controller.logStats()
+    preClass.shared_preclassifier.logReport()
+    nearDup.shared_detector.logReport()
+    failQueue.shared_queue.logStats()
+    tokBudget.shared_budget.logStats()
+    writeRunReport(args)
+    runtime.shared_context.close()
 
-    #Write to DB
-    dbConn.writeToDatabase(dataset_df)
+
+def replayFailures(args, __logger):
+    #Own journal file, so replaying never truncates the journal of an interrupted run that still has to be resumed
+    journal.shared_journal.path = shardRun.taggedPath(dep.journal_path, '_replay')
+    completed = journal.shared_journal.start(False)
+
+    idmemos = failQueue.shared_queue.takePending()
+    __logger.info(f'Replaying {len(idmemos)} rows from the failure queue')
+    if idmemos:
+        processSelection(dbConn.databaseConnection(), failQueue.replaySelect(idmemos), args, __logger, completed)
+    failQueue.shared_queue.finishReplay()
+    finishRun(args)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    __logger = configure_logging()
+    __logger.info('Logging is set up, script has started')
+
+    if args.shards:
+        #Shards are claimed from the lease table by this process' workers and by any other pod running the same --run-id
+        shardRun.runSharded(args)
+        __logger.info('Script finished')
+        return
+
+    if args.replay:
+        replayFailures(args, __logger)
+        __logger.info('Script finished')
+        return
+
+    completed = journal.shared_journal.start(args.resume)
+
+    #Rows whose text is unchanged since the last run are refreshed in SQL and never read
+    with runMetrics.shared_metrics.stage('refresh_unchanged') as tracked:
+        tracked['rows'] = dbConn.refreshUnchangedRows()
+
+    #Read from DB, process and write back
+    conn = dbConn.databaseConnection()
+    processSelection(conn, dep.SELECT_sql_script, args, __logger, completed)
+
+    finishRun(args)
     __logger.info('Script finished')
 
+
+def writeRunReport(args):
+    report = runMetrics.shared_metrics.report({
+        'settings': {'pipeline': args.pipeline, 'stream': args.stream, 'num_workers': dep.num_workers, 'chunk_size': dep.chunk_size, 'parse_batch_size': args.parse_batch_size, 'dedup': args.dedup},
+        'failed_rows': failQueue.shared_queue.stats(),
+        'response_cache': respCache.shared_cache.stats(),
+        'concurrency': adaptConc.shared_controller.stats(),
+        'near_duplicates': nearDup.shared_detector.stats(),
+        'token_budget': tokBudget.shared_budget.stats(),
+        'preclassifier': preClass.shared_preclassifier.stats(),
+    })
+    runMetrics.shared_metrics.writeReport(report, dep.run_report_path)
+    if dep.prometheus_textfile_path:
+        runMetrics.shared_metrics.writePrometheus(report, dep.prometheus_textfile_path)
+
 if __name__ == "__main__":
     setattr(sys, "excepthook", dep.handle_exception)
     main()
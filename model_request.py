@@ -0,0 +1,120 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# One Azure OpenAI chat request with the retry policy shared by the improve and the parse step, in a blocking (thread pool) and an awaitable (async pipeline) variant.
+# Both variants take an adaptive concurrency slot and then a rate limiter slot per try, time only the request itself, feed the response headers back to the rate limiter and record the call in run_metrics.py.
+# -- Transient errors (throttling, timeouts, connection errors, 408/409 and 5xx responses) are retried with exponential backoff, or after the rate limiter's retry-after pause, after dep.max_tries the rows go to the retry queue of failure_queue.py
+# -- Rejected requests (BadRequestError, e.g. the content filter) are permanent and go to the dead-letter table without retries, unless the caller isolates the rows itself
+#################################################### OVERVIEW (END) ######################################################
+
+import adaptive_concurrency as adaptConc
+import asyncio
+import dependencies as dep
+import failure_queue as failQueue
+import logging
+import random
+import rate_limiter as rateLim
+import requests
+import run_metrics as runMetrics
+import runtime_context as runtime
+import time
+import token_budget as tokBudget
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from openai import APIConnectionError, APIStatusError, BadRequestError, InternalServerError, RateLimitError
+
+## ------ VARIABLES ------ ##
+transient_errors = (HttpResponseError, ServiceRequestError, requests.exceptions.ReadTimeout, APIConnectionError, RateLimitError, InternalServerError) # InternalServerError covers every 5xx status
+retried_status_codes = (408, 409) # request timeout and lock conflict, which the openai client retried itself before max_retries=0
+failure_stages = {'parse_batch': 'parse'} # metrics stage -> failure queue stage, batched rows are replayed as single parse rows
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def isTransient(error):
+    return isinstance(error, transient_errors) or (isinstance(error, APIStatusError) and error.status_code in retried_status_codes)
+
+def _observeResponse(stage, call_start, raw_response):
+    rateLim.shared_limiter.observeHeaders(raw_response.headers)
+    response = raw_response.parse()
+    runMetrics.shared_metrics.recordCall(stage, time.perf_counter() - call_start, response.usage)
+    return response
+
+def _transientFailure(stage, rows, retry, e):
+    #Returns the backoff before the next try, or None once the tries are used up and the rows are in the failure queue
+    logger.error(f"Error type encountered: {e}")
+    retry_after = rateLim.shared_limiter.observeError(e)
+    runMetrics.shared_metrics.recordRetry(stage, e)
+    if retry < dep.max_tries - 1:
+        if retry_after:
+            #The rate limiter pauses every worker for retry-after, the next acquire() waits for it, so no extra backoff on top
+            backoff_time = random.random() * 0.1 # jitter only, so the paused workers don't retry in lockstep
+        else:
+            backoff_time = (2 ** retry) + random.random() # Exponential backoff with jitter
+        logger.warning(f"Retrying in {backoff_time} seconds, number of retries {retry}")
+        return backoff_time
+
+    logger.error(f"Max retries exceeded. Skipping {len(rows)} rows: {[row['idmemo'] for row in rows]}.")
+    for row in rows:
+        failQueue.shared_queue.record(failure_stages.get(stage, stage), row, e)
+    return None
+
+def _rejected(stage, rows, e, isolate_rejected):
+    if isolate_rejected:
+        #One report can trip the content filter for a whole batch, the caller retries its rows one by one
+        runMetrics.shared_metrics.recordRetry(stage, e)
+        logger.warning(f"Error type: {e}.\nRequest was not accepted, falling back to one request per report for {len(rows)} rows")
+        return
+    #Permanent: the same request is rejected every time, so it goes to the dead-letter table without retries
+    logger.error(f"Error type {e} \nYour request was not accepted due to content policy violations (AZURE/OpenAI). Skipping {len(rows)} rows: {[row['idmemo'] for row in rows]}.")
+    for row in rows:
+        failQueue.shared_queue.record(failure_stages.get(stage, stage), row, e)
+
+def requestCompletion(stage, rows, messages, max_tokens, isolate_rejected=False, **options):
+    #Returns (response, error). The response is None when the request failed for good, the rows are then in the failure queue (or left to the caller with isolate_rejected)
+    error = None
+    tokens = tokBudget.shared_budget.requestTokens(messages, max_tokens)
+    for retry in range(dep.max_tries):
+        try:
+            #Concurrency slot first, then the rate limiter (due to token rate limit), the latency starts when the request is sent
+            with adaptConc.shared_controller.slot(lambda: rateLim.shared_limiter.acquire(tokens)):
+                call_start = time.perf_counter()
+                raw_response = runtime.shared_context.azureClient().chat.completions.with_raw_response.create(
+                    model=dep.engine, messages=messages, max_tokens=max_tokens, **options)
+            return _observeResponse(stage, call_start, raw_response), None
+
+        except BadRequestError as e:
+            _rejected(stage, rows, e, isolate_rejected)
+            return None, e
+        except Exception as e:
+            if not isTransient(e): raise
+            error = e
+            backoff_time = _transientFailure(stage, rows, retry, e)
+            if backoff_time is None: break
+            time.sleep(backoff_time)
+    return None, error
+
+async def requestCompletionAsync(client, stage, rows, messages, max_tokens, isolate_rejected=False, **options):
+    #Same as requestCompletion, but awaits the AsyncAzureOpenAI client instead of blocking a thread
+    error = None
+    tokens = tokBudget.shared_budget.requestTokens(messages, max_tokens)
+    for retry in range(dep.max_tries):
+        try:
+            async with adaptConc.shared_controller.slotAsync(lambda: rateLim.shared_limiter.acquireAsync(tokens)):
+                call_start = time.perf_counter()
+                raw_response = await client.chat.completions.with_raw_response.create(
+                    model=dep.engine, messages=messages, max_tokens=max_tokens, **options)
+            return _observeResponse(stage, call_start, raw_response), None
+
+        except BadRequestError as e:
+            _rejected(stage, rows, e, isolate_rejected)
+            return None, e
+        except Exception as e:
+            if not isTransient(e): raise
+            error = e
+            backoff_time = _transientFailure(stage, rows, retry, e)
+            if backoff_time is None: break
+            await asyncio.sleep(backoff_time)
+    return None, error
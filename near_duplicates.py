@@ -0,0 +1,147 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Near-duplicate detection for the report descriptions, run before the AI steps so identical or almost identical reports (templated text, copy-paste across sister vessels,
+# case/whitespace edits) are improved and parsed once. _value is normalized and cut into word shingles, every report gets a MinHash signature (NumPy, no extra dependencies),
+# and locality-sensitive hashing over bands of the signature finds candidate pairs, which are merged when their estimated Jaccard similarity is at least dep.dedup_threshold.
+# Only one representative per cluster is sent to the model; its improved text and topics are fanned back out to every member idmemo. The dedup ratio is logged per run.
+#################################################### OVERVIEW (END) ######################################################
+
+import checkpoint_journal as journal
+import dependencies as dep
+import failure_queue as failQueue
+import logging
+import numpy as np
+import pandas as pd
+import re
+import threading
+import zlib
+
+## ------ VARIABLES ------ ##
+hash_prime = (1 << 31) - 1 # keeps a * x + b below 2**63, so the permutations never overflow uint64
+result_columns = ['aiimproveddescription', 'aiparsedtopics', 'aiparsedtopics2']
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def normalizeText(text):
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', str(text).lower()).split())
+
+def shingles(normalized_text, size):
+    words = normalized_text.split()
+    if len(words) <= size: return {normalized_text}
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i != root_j:
+            self.parent[max(root_i, root_j)] = min(root_i, root_j) # the earliest row stays the root, and becomes the representative
+
+
+class NearDuplicateDetector:
+    def __init__(self, threshold, num_perm=128, bands=16, shingle_size=3, seed=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.perm_a = rng.integers(1, hash_prime, size=num_perm, dtype=np.uint64)
+        self.perm_b = rng.integers(0, hash_prime, size=num_perm, dtype=np.uint64)
+        self.total_rows = 0
+        self.model_rows = 0
+        self.lock = threading.Lock()
+
+    def signature(self, normalized_text):
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) % hash_prime for shingle in shingles(normalized_text, self.shingle_size)), dtype=np.uint64)
+        return ((np.outer(self.perm_a, hashes) + self.perm_b[:, None]) % hash_prime).min(axis=1)
+
+    def clusters(self, texts):
+        #Returns, for every text, the position of its cluster representative (itself when it has no duplicates). Empty texts are never merged
+        normalized = [normalizeText(text) if pd.notnull(text) and str(text).strip() else None for text in texts]
+        union_find = UnionFind(len(normalized))
+
+        first_seen, candidates = {}, []
+        for i, text in enumerate(normalized):
+            if text is None: continue
+            if text in first_seen:
+                union_find.union(first_seen[text], i) # exact duplicate after normalization, no need for a signature
+            else:
+                first_seen[text] = i
+                candidates.append(i)
+
+        signatures = {i: self.signature(normalized[i]) for i in candidates}
+        for band in range(self.bands):
+            buckets = {}
+            start = band * self.rows_per_band
+            for i in candidates:
+                buckets.setdefault(signatures[i][start:start + self.rows_per_band].tobytes(), []).append(i)
+            for members in buckets.values():
+                for j in members[1:]:
+                    if union_find.find(members[0]) != union_find.find(j) and np.mean(signatures[members[0]] == signatures[j]) >= self.threshold:
+                        union_find.union(members[0], j)
+
+        return [union_find.find(i) for i in range(len(normalized))]
+
+    def collapse(self, dataset_df):
+        #Returns (representative rows for the model, member rows, representative index of every member row)
+        representatives = self.clusters(dataset_df['_value'].tolist())
+        representative_of = pd.Series(dataset_df.index[representatives], index=dataset_df.index)
+        is_member = representative_of.index != representative_of.values
+
+        with self.lock:
+            self.total_rows += len(dataset_df)
+            self.model_rows += int((~is_member).sum())
+        logger.info(f'Near-duplicate detection: {len(dataset_df)} rows collapsed to {int((~is_member).sum())} representatives')
+        return dataset_df[~is_member].copy(), dataset_df[is_member], representative_of[is_member]
+
+    def fanOut(self, processed_df, members_df, representative_of):
+        #Copies the results of each representative to its members, journals them and returns all rows in the original order.
+        #Members of a representative that failed share its failure: they go to the failure queue instead of the journal, so --resume and --replay pick them up again
+        if members_df.empty: return processed_df
+
+        members_df = members_df.copy()
+        results = processed_df.reindex(index=representative_of.values, columns=result_columns)
+        for column in result_columns:
+            members_df[column] = results[column].tolist()
+        representative_idmemos = processed_df['idmemo'].reindex(representative_of.values).tolist()
+        failed_members = 0
+        for (_, row), representative_idmemo in zip(members_df.iterrows(), representative_idmemos):
+            failed_stage = None
+            failure = failQueue.shared_queue.failureOf(representative_idmemo)
+            if failure is not None:
+                failed_stage, classification, reason = failure
+                failQueue.shared_queue.record(failed_stage, row, classification=classification, reason=reason)
+                failed_members += 1
+            if failed_stage != 'improve':
+                journal.shared_journal.record('improve', row, row['aiimproveddescription'])
+            if failed_stage is None:
+                journal.shared_journal.record('parse', row, {'aiparsedtopics': row['aiparsedtopics'], 'aiparsedtopics2': row['aiparsedtopics2']})
+        if failed_members:
+            logger.warning(f'{failed_members} near-duplicate members share the failure of their representative and were added to the failure queue')
+        return pd.concat([processed_df, members_df]).sort_index()
+
+    def stats(self):
+        with self.lock:
+            return {'rows': self.total_rows, 'model_rows': self.model_rows, 'dedup_ratio': round(1 - self.model_rows / self.total_rows, 4) if self.total_rows else 0}
+
+    def logReport(self):
+        if not self.total_rows: return
+        stats = self.stats()
+        logger.info(f"Near-duplicate dedup: {stats['rows']} rows sent as {stats['model_rows']} model inputs (dedup ratio {stats['dedup_ratio']:.1%})")
+
+
+shared_detector = NearDuplicateDetector(dep.dedup_threshold, dep.dedup_num_perm, dep.dedup_bands, dep.dedup_shingle_size)
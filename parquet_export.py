@@ -0,0 +1,104 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Columnar audit export of the processed reports, replacing the parsed_Text.csv dump. Each processed batch is appended to one Parquet file (dep.export_path) as its own row group,
+# compressed with dep.parquet_compression, with a fixed Arrow schema: aiparsedtopics is a list<string> column and the dates are real timestamps, so nothing has to be re-parsed from text.
+# The file stays open for the whole run (and across the shards of a worker) and is closed by main.finishRun().
+# The reader utility loads one or more exports (e.g. the _worker<n> files of a sharded run), optionally only some columns or idmemos:
+#   python parquet_export.py "parsed_Text*.parquet" --idmemo 1000001 --columns idmemo aiparsedtopics
+#################################################### OVERVIEW (END) ######################################################
+
+import argparse
+import dependencies as dep
+import glob
+import logging
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import threading
+
+## ------ VARIABLES ------ ##
+export_schema = pa.schema([
+    ('idmemo', pa.int64()),
+    ('changeddate', pa.timestamp('us')),
+    ('shortdescription', pa.string()),
+    ('aiimproveddescription', pa.string()),
+    ('aiparsedtopics', pa.list_(pa.string())),
+    ('lastrundate', pa.timestamp('us')),
+    ('updatedate', pa.timestamp('us')),
+    ('source', pa.string()),
+    ('aiparsedtopics2', pa.string()), # JSON text, as written to the database
+    ('texthash', pa.string()),
+])
+timestamp_columns = ['changeddate', 'lastrundate', 'updatedate']
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def toArrowTable(df):
+    export_df = df.reindex(columns=export_schema.names)
+    for column in timestamp_columns:
+        export_df[column] = pd.to_datetime(export_df[column], errors='coerce') #lastrundate/updatedate are formatted strings, changeddate comes from the database
+    export_df['aiparsedtopics'] = [topics if isinstance(topics, list) else None for topics in export_df['aiparsedtopics']]
+    return pa.Table.from_pandas(export_df, schema=export_schema, preserve_index=False)
+
+
+class ParquetExportWriter:
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self.writer = None
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def exportPath(self):
+        #Tagged per worker in sharded mode, the same way as the journal and run report
+        root, extension = os.path.splitext(self.path)
+        return f'{root}{dep.output_tag}{extension}'
+
+    def write(self, df):
+        if df.empty: return
+        table = toArrowTable(df)
+        with self.lock:
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.exportPath(), export_schema, compression=self.compression)
+            self.writer.write_table(table, row_group_size=len(table)) # one row group per processed batch
+            self.rows += len(table)
+
+    def close(self):
+        with self.lock:
+            if self.writer is None: return
+            self.writer.close()
+            self.writer = None
+            logger.info(f'Exported {self.rows} rows to {self.exportPath()}')
+
+
+def readExport(pattern, columns=None, idmemo=None):
+    #Loads every export matching the pattern into one dataframe, reading only the requested columns and row groups that can contain the idmemos
+    paths = sorted(glob.glob(pattern))
+    if not paths: raise FileNotFoundError(f'No Parquet export matches {pattern}')
+    filters = [('idmemo', 'in', list(idmemo))] if idmemo else None
+    return pq.read_table(paths if len(paths) > 1 else paths[0], columns=columns, filters=filters).to_pandas()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Read Parquet audit exports of the AI processing')
+    parser.add_argument('pattern', nargs='?', default=dep.export_path, help='export file, or a glob pattern for several (quote it)')
+    parser.add_argument('--columns', nargs='+', help='only read these columns')
+    parser.add_argument('--idmemo', nargs='+', type=int, help='only rows with these idmemos')
+    parser.add_argument('--limit', type=int, default=20, help='rows to print')
+    args = parser.parse_args(argv)
+
+    export_df = readExport(args.pattern, args.columns, args.idmemo)
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.max_colwidth', 80):
+        print(export_df.head(args.limit))
+    print(f'{len(export_df)} rows')
+
+
+shared_writer = ParquetExportWriter(dep.export_path, dep.parquet_compression)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 #################################################### OVERVIEW (START) ####################################################
-# LAST CHANGES [AUTHOR]: Erlend Skinnemoen
-# LAST CHANGES [DATE]: 29.02.2024
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
 #
 # DESCRIPTION 
 # Script does the parsing and categorizing of textual data using Azure's AI services. It extracts relevant topics from improved text descriptions based on pre-defined categories, converting string responses into structured lists or JSON formats as required. 
@@ -8,24 +8,20 @@
 # The output is a list =< 6 topics related to each "event"/description as a list of string and JSON 
 #################################################### OVERVIEW (END) ######################################################
 
+import checkpoint_journal as journal
 import dependencies as dep
 import json
 import logging
+import model_request as modelReq
 import pandas as pd
-import random
-import requests
-import time 
+import response_cache as respCache
+import token_budget as tokBudget
 
-from azure.core.exceptions import HttpResponseError, ServiceRequestError
 from concurrent.futures import as_completed
 from openai import BadRequestError
 
-## ----- VARIABLES ----- ##
-parsed_text=[]
-
 ## ------ FUNCTIONS ------ ##
 logger = logging.getLogger(__name__)
-azure_client = dep.client()
 
 def extractResponse(response):
     try: 
@@ -37,91 +33,204 @@ def extractResponse(response):
     except Exception as e:
         logger.error("Error extracting content from response: %s", e)
 
+def topicsResponse(response):
+    #An answer cut off at max_tokens ends in a partial category name, which is dropped instead of stored as a topic
+    chat_response = extractResponse(response)
+    if chat_response and response.choices[0].finish_reason == 'length':
+        logger.warning(f"Topic answer was cut off at max_tokens, dropping its last line: {chat_response.splitlines()[-1]!r}")
+        chat_response = chat_response.rsplit('\n', 1)[0] if '\n' in chat_response.strip() else ''
+    return chat_response
 
-def string2list(string_response):
+def normalizeTopics(string_response):
+    #One topic per line; stray whitespace, bullets and empty lines are dropped once here for both the list and the JSON column
     try: 
-        list_response = string_response.split('\n')
-        return list_response
+        topics = (line.strip().lstrip('-* ').strip() for line in string_response.split('\n'))
+        return [topic for topic in topics if topic]
     except Exception as e:
         logger.error("Error converting string to list: %s", e)
         return []
 
-def string2json(string_response):
-    try:
-        json_response = json.dumps(string_response.split('\n'))  
-        return json_response
-    except Exception as e:
-        logger.error("Error converting string to JSON: %s", e)
-        return json.dumps([])  
-
+def topicUpdates(row, chat_response):
+    list_response = normalizeTopics(chat_response)
+    json_response = json.dumps(list_response)
+    journal.shared_journal.record('parse', row, {'aiparsedtopics': list_response, 'aiparsedtopics2': json_response})
+    return row.name, {'idmemo': row['idmemo'],'aiimproveddescription': row['aiimproveddescription'], 'aiparsedtopics': list_response,'aiparsedtopics2' : json_response }
+
+def parseMessages(input_text):
+    return [
+        {
+            "role": "system", 
+            "content": dep.promt_parseText
+        },
+        {
+            "role": "user",
+            "content": input_text
+        }
+    ]
 
-def formatResponse(temp_df, column_name, row_index, input_data):
-    try: 
-        temp_df.at[row_index, column_name ] = input_data 
-    except Exception as e: 
-        logger.error("Error formatting response: %s", e)
+def aiTopicResponse(row):
+    input_text = row['aiimproveddescription']
 
-        
+    if pd.isnull(input_text): return None
 
-def aiTopicResponse(row):
+    cache_key = respCache.shared_cache.key(dep.engine, dep.promt_parseText, 0.5, input_text)
+    chat_response = respCache.shared_cache.get(cache_key)
+    if chat_response is not None: return topicUpdates(row, chat_response)
+
+    #Overlong texts are trimmed (see token_budget.py). max_tokens stays at dep.parse_max_tokens, the answer is up to six category names whatever the input length
+    prompt_text = tokBudget.shared_budget.trimText(input_text, dep.parse_max_input_tokens)
+    messages = parseMessages(prompt_text)
+    max_tokens = dep.parse_max_tokens
+    response, error = modelReq.requestCompletion('parse', [row], messages, max_tokens, timeout=60, temperature=0.5, n=1)
+    if response is None: return None
+    chat_response = topicsResponse(response)
+    respCache.shared_cache.put(cache_key, chat_response)
+    return topicUpdates(row, chat_response)
+
+async def aiTopicResponseAsync(client, row):
+    #Same cache/failure semantics as aiTopicResponse, but awaits the AsyncAzureOpenAI client instead of blocking a thread
     input_text = row['aiimproveddescription']
-    input_id = row['idmemo']
 
     if pd.isnull(input_text): return None
 
-    for retry in range(dep.max_tries):
-        try: 
-            response = azure_client.chat.completions.create(
-                model = dep.engine,
-                timeout = 60,
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": dep.promt_parseText
-                    },
-                    {
-                        "role": "user",
-                        "content": input_text
-                    }
-              ],
-              temperature=0.5,
-              max_tokens=100,
-              n=1
-            )
-            chat_response = extractResponse(response)
-            list_response = string2list(chat_response)
-            json_response = string2json(chat_response)
-            return row.name, {'idmemo': input_id,'aiimproveddescription': input_text, 'aiparsedtopics': list_response,'aiparsedtopics2' : json_response }
-
-        except(HttpResponseError, ServiceRequestError, requests.exceptions.ReadTimeout) as e:                   
-            logger.error(f"Error type encountered: {e}")
-            if retry < dep.max_tries - 1:
-                backoff_time = (2 ** retry) + random.random() # Exponential backoff with jitter
-                logger.warning(f"Error type: {e}.\nRetrying in {backoff_time} seconds, number of retries {retry}")
-                time.sleep(backoff_time)
-            else:
-                logger.error(f"Max retries exceeded. Skipping this row: {row['idmemo']}.")
-                dep.parsed_failed_rows.append(row)
-                return None
-        except(BadRequestError) as e:
-            if retry < dep.max_tries - 1:
-                backoff_time = (2 ** retry) + random.random() # Exponential backoff with jitter
-                logger.warning(f"Error type: {e}.\nRetrying in {backoff_time} seconds, number of retries {retry}")
-                time.sleep(backoff_time)
-            else: 
-                logger.error(f"Error type {e} \nYour request was not accepted due to content policy violations (AZURE/OpenAI). Skipping this row: {row['idmemo']}.") 
-                dep.parsed_failed_rows.append(row)
-                return None
-        time.sleep(1)
+    cache_key = respCache.shared_cache.key(dep.engine, dep.promt_parseText, 0.5, input_text)
+    chat_response = respCache.shared_cache.get(cache_key)
+    if chat_response is not None: return topicUpdates(row, chat_response)
+
+    prompt_text = tokBudget.shared_budget.trimText(input_text, dep.parse_max_input_tokens)
+    messages = parseMessages(prompt_text)
+    max_tokens = dep.parse_max_tokens
+    response, error = await modelReq.requestCompletionAsync(client, 'parse', [row], messages, max_tokens, timeout=60, temperature=0.5, n=1)
+    if response is None: return None
+    chat_response = topicsResponse(response)
+    respCache.shared_cache.put(cache_key, chat_response)
+    return topicUpdates(row, chat_response)
+
+## ------ BATCHED PARSING ------ ##
+#Several reports share one request (and one copy of the system prompt with all categories); the answer is a JSON object keyed by idmemo
+def parseBatchMessages(rows):
+    reports = {str(row['idmemo']): tokBudget.shared_budget.trimText(row['aiimproveddescription'], dep.parse_max_input_tokens) for row in rows}
+    return [
+        {
+            "role": "system", 
+            "content": dep.promt_parseTextBatch
+        },
+        {
+            "role": "user",
+            "content": json.dumps(reports, ensure_ascii=False)
+        }
+    ]
+
+def splitParseBatches(rows, max_rows, token_budget):
+    #Greedy packing: a new batch starts when the next report would exceed the row limit or the estimated token budget
+    base_tokens = tokBudget.shared_budget.requestTokens(parseBatchMessages([]), 0)
+    batches, batch, batch_tokens = [], [], base_tokens
+    for row in rows:
+        row_tokens = min(tokBudget.shared_budget.countTokens(str(row['aiimproveddescription'])), dep.parse_max_input_tokens) + dep.parse_batch_tokens_per_report
+        if batch and (len(batch) >= max_rows or batch_tokens + row_tokens > token_budget):
+            batches.append(batch)
+            batch, batch_tokens = [], base_tokens
+        batch.append(row)
+        batch_tokens += row_tokens
+    if batch: batches.append(batch)
+    return batches
+
+def batchTopicUpdates(rows, chat_response):
+    #Returns (results for the rows answered correctly, rows missing or malformed in the response)
+    try:
+        topics_by_id = json.loads(chat_response)
+    except (TypeError, ValueError):
+        topics_by_id = None
+    if not isinstance(topics_by_id, dict):
+        logger.warning(f"Malformed batch response, falling back to one request per report for {len(rows)} rows")
+        return [], rows
+
+    results, fallback_rows = [], []
+    for row in rows:
+        topics = topics_by_id.get(str(row['idmemo']))
+        if isinstance(topics, list) and all(isinstance(topic, str) for topic in topics):
+            chat_response = '\n'.join(topics)
+            respCache.shared_cache.put(batchCacheKey(row), chat_response)
+            results.append(topicUpdates(row, chat_response))
+        else:
+            fallback_rows.append(row)
+    if fallback_rows:
+        logger.warning(f"Batch response had no valid topics for {len(fallback_rows)} rows, falling back to one request per report")
+    return results, fallback_rows
+
+def batchCacheKey(row):
+    return respCache.shared_cache.key(dep.engine, dep.promt_parseTextBatch, 0.5, row['aiimproveddescription'])
+
+def cachedBatchRows(rows):
+    #Returns (results answered from the cache, rows that still need the model)
+    results, pending_rows = [], []
+    for row in rows:
+        if pd.isnull(row['aiimproveddescription']): continue
+        chat_response = respCache.shared_cache.get(batchCacheKey(row))
+        if chat_response is not None: results.append(topicUpdates(row, chat_response))
+        else: pending_rows.append(row)
+    return results, pending_rows
+
+def aiTopicResponseBatch(rows):
+    results, rows = cachedBatchRows(rows)
+    if not rows: return results
+
+    messages = parseBatchMessages(rows)
+    max_tokens = dep.parse_batch_tokens_per_report * len(rows)
+    response, error = modelReq.requestCompletion('parse_batch', rows, messages, max_tokens, isolate_rejected=True, timeout=60, temperature=0.5, n=1)
+    if response is not None:
+        batch_results, fallback_rows = batchTopicUpdates(rows, extractResponse(response))
+    elif isinstance(error, BadRequestError):
+        batch_results, fallback_rows = [], rows
+    else:
+        return results # retries exhausted, the rows are in the failure queue
+
+    results.extend(batch_results)
+    for row in fallback_rows:
+        result = aiTopicResponse(row)
+        if result: results.append(result)
+    return results
+
+async def aiTopicResponseBatchAsync(client, rows):
+    #Same as aiTopicResponseBatch, but awaits the AsyncAzureOpenAI client instead of blocking a thread
+    results, rows = cachedBatchRows(rows)
+    if not rows: return results
+
+    messages = parseBatchMessages(rows)
+    max_tokens = dep.parse_batch_tokens_per_report * len(rows)
+    response, error = await modelReq.requestCompletionAsync(client, 'parse_batch', rows, messages, max_tokens, isolate_rejected=True, timeout=60, temperature=0.5, n=1)
+    if response is not None:
+        batch_results, fallback_rows = batchTopicUpdates(rows, extractResponse(response))
+    elif isinstance(error, BadRequestError):
+        batch_results, fallback_rows = [], rows
+    else:
+        return results # retries exhausted, the rows are in the failure queue
+
+    results.extend(batch_results)
+    for row in fallback_rows:
+        result = await aiTopicResponseAsync(client, row)
+        if result: results.append(result)
+    return results
+
+def applyParseResults(df, results):
+    #Collects the results column-wise and joins them into the dataframe with one assignment per column
+    row_indexes, topics, topics_json = [], [], []
+    for row__index, updates in results:
+        row_indexes.append(row__index)
+        topics.append(updates['aiparsedtopics'])
+        topics_json.append(updates['aiparsedtopics2'])
+    if not row_indexes: return
+
+    for column_name in ('aiparsedtopics', 'aiparsedtopics2'):
+        if column_name not in df:
+            df[column_name] = pd.Series(dtype=object)
+    df.loc[row_indexes, 'aiparsedtopics'] = pd.Series(topics, index=row_indexes, dtype=object)
+    df.loc[row_indexes, 'aiparsedtopics2'] = pd.Series(topics_json, index=row_indexes, dtype=object)
 
 def aggregateParseResponse(futures, df):
+    results = []
     for future in as_completed(futures):
         result = future.result()
-        if result:
-            row__index, updates = result
-            for column_name, input_data in updates.items():
-                formatResponse(df, column_name, row__index, input_data)
-
-
-
-
+        if not result: continue
+        results.extend(result if isinstance(result, list) else [result]) #batched requests return a list of results
+    applyParseResults(df, results)
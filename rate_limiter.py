@@ -0,0 +1,107 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Token-bucket rate limiter shared by every worker (threads and asyncio tasks) that calls the Azure OpenAI deployment.
+# It enforces the deployment's requests-per-minute and tokens-per-minute quotas (dep.requests_per_minute / dep.tokens_per_minute) using an estimate of prompt + max_tokens per call,
+# and adapts to what Azure reports back: the x-ratelimit-remaining-* headers shrink the local buckets and retry-after pauses every worker until the deployment accepts requests again.
+#################################################### OVERVIEW (END) ######################################################
+
+import asyncio
+import dependencies as dep
+import logging
+import threading
+import time
+
+## ------ VARIABLES ------ ##
+chars_per_token = 4 # rough average for english text with the gpt-35-turbo tokenizer
+tokens_per_message = 4 # chat-format overhead per message
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def estimateTokens(messages, max_tokens):
+    #Azure counts prompt tokens + max_tokens towards the TPM quota when the request is accepted
+    prompt_tokens = sum(len(message['content']) // chars_per_token + tokens_per_message for message in messages)
+    return prompt_tokens + max_tokens
+
+
+def _headerValue(headers, name):
+    try:
+        value = headers.get(name) if headers is not None else None
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = float(requests_per_minute)
+        self.token_capacity = float(tokens_per_minute)
+        self.request_level = self.request_capacity
+        self.token_level = self.token_capacity
+        self.blocked_until = 0.0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_level = min(self.request_capacity, self.request_level + elapsed * self.request_capacity / 60)
+        self.token_level = min(self.token_capacity, self.token_level + elapsed * self.token_capacity / 60)
+
+    def _reserve(self, tokens):
+        #Returns 0 when the call may proceed (and books its cost), otherwise the number of seconds to wait before trying again
+        tokens = min(tokens, self.token_capacity) # a single oversized call must not wait forever
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.request_level >= 1 and self.token_level >= tokens:
+                self.request_level -= 1
+                self.token_level -= tokens
+                return 0
+            request_wait = max(0.0, 1 - self.request_level) * 60 / self.request_capacity
+            token_wait = max(0.0, tokens - self.token_level) * 60 / self.token_capacity
+            return max(request_wait, token_wait)
+
+    def acquire(self, tokens):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0: return
+            time.sleep(wait)
+
+    async def acquireAsync(self, tokens):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0: return
+            await asyncio.sleep(wait)
+
+    def observeHeaders(self, headers):
+        #Trust the server when it has less quota left than the local buckets believe (e.g. other clients share the deployment)
+        remaining_requests = _headerValue(headers, 'x-ratelimit-remaining-requests')
+        remaining_tokens = _headerValue(headers, 'x-ratelimit-remaining-tokens')
+        retry_after_ms = _headerValue(headers, 'retry-after-ms')
+        retry_after = retry_after_ms / 1000 if retry_after_ms is not None else _headerValue(headers, 'retry-after')
+
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if remaining_requests is not None:
+                self.request_level = min(self.request_level, remaining_requests)
+            if remaining_tokens is not None:
+                self.token_level = min(self.token_level, remaining_tokens)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                logger.warning(f"Azure OpenAI asked to retry after {retry_after} seconds, pausing all workers")
+        return retry_after
+
+    def observeError(self, error):
+        #Returns the retry-after of a throttled call. The limiter then owns the backoff: every worker, including the one retrying, waits in acquire() until the pause is over
+        response = getattr(error, 'response', None)
+        return self.observeHeaders(getattr(response, 'headers', None))
+
+
+shared_limiter = RateLimiter(dep.requests_per_minute, dep.tokens_per_minute)
@@ -0,0 +1,97 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Persistent, content-addressed cache for the Azure OpenAI responses, placed in front of both the text improvement and the topic parsing calls.
+# The key is a hash of the engine, the system prompt (which embeds categories.txt for the parsing step), the temperature and the input text, so a report that is re-selected
+# without its text changing, or an identical description on another vessel, is answered from disk. Editing a prompt or the categories changes the key and invalidates old entries automatically.
+# Entries are kept in a local SQLite file and evicted least-recently-used once the file grows above dep.cache_max_bytes.
+#################################################### OVERVIEW (END) ######################################################
+
+import dependencies as dep
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    def __init__(self, path, max_bytes, enabled=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        #Opened on first use so importing the module never touches the disk
+        if self.conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self.conn
+
+    @staticmethod
+    def key(engine, system_prompt, temperature, text):
+        digest = hashlib.sha256()
+        for part in (engine, system_prompt, repr(temperature), text):
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\x00') # separator, so ('ab', 'c') and ('a', 'bc') hash differently
+        return digest.hexdigest()
+
+    def get(self, key):
+        if not self.enabled: return None
+        with self.lock:
+            conn = self._connect()
+            found = conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if found is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return found[0]
+
+    def put(self, key, value):
+        if not self.enabled or not value: return
+        size = len(key) + len(value.encode('utf-8'))
+        with self.lock:
+            conn = self._connect()
+            previous = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+            self.total_bytes += size - (previous[0] if previous else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        #Free 10% headroom below the limit at once, so eviction does not run on every subsequent put
+        target = self.max_bytes * 0.9
+        evict_keys = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self.total_bytes <= target: break
+            evict_keys.append((key,))
+            self.total_bytes -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evict_keys)
+        self.evictions += len(evict_keys)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'bytes': self.total_bytes}
+
+    def logStats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        logger.info(f'Response cache: {self.hits} hits, {self.misses} misses (hit rate {hit_rate:.1%}), {self.evictions} evictions, {self.total_bytes / 1e6:.1f} MB on disk')
+
+
+shared_cache = ResponseCache(dep.cache_path, dep.cache_max_bytes, dep.cache_enabled)
@@ -0,0 +1,136 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Run instrumentation for every stage of the microservice (DB read, improve, parse, Parquet export and DB write).
+# Each model call records its latency, the prompt/completion tokens from response.usage and any retried exception by class.
+# At the end of main() a machine-readable JSON run report is written (dep.run_report_path), and optionally a Prometheus textfile (dep.prometheus_textfile_path) for the node_exporter textfile collector.
+#################################################### OVERVIEW (END) ######################################################
+
+import json
+import logging
+import numpy as np
+import os
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stage_seconds = defaultdict(float)
+        self.stage_rows = defaultdict(int)
+        self.call_latencies = defaultdict(list)
+        self.prompt_tokens = defaultdict(int)
+        self.completion_tokens = defaultdict(int)
+        self.retries = defaultdict(lambda: defaultdict(int))
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        #Yields a dict, so the row count can be filled in when it is only known at the end of the stage
+        tracked = {'rows': rows}
+        start = time.perf_counter()
+        try:
+            yield tracked
+        finally:
+            with self.lock:
+                self.stage_seconds[name] += time.perf_counter() - start
+                self.stage_rows[name] += tracked['rows']
+
+    def timedIterator(self, name, iterator):
+        #Times every next() of a generator (e.g. the streamed DB read) as the given stage
+        iterator = iter(iterator)
+        while True:
+            with self.stage(name) as tracked:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                tracked['rows'] = len(item)
+            yield item
+
+    def recordCall(self, stage, latency, usage=None):
+        with self.lock:
+            self.call_latencies[stage].append(latency)
+            if usage is not None:
+                self.prompt_tokens[stage] += getattr(usage, 'prompt_tokens', 0) or 0
+                self.completion_tokens[stage] += getattr(usage, 'completion_tokens', 0) or 0
+
+    def recordRetry(self, stage, error):
+        with self.lock:
+            self.retries[stage][type(error).__name__] += 1
+
+    def report(self, extra=None):
+        with self.lock:
+            model_calls = {}
+            for stage, latencies in self.call_latencies.items():
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+                model_calls[stage] = {
+                    'calls': len(latencies),
+                    'latency_seconds': {'p50': round(float(p50), 4), 'p95': round(float(p95), 4), 'p99': round(float(p99), 4), 'max': round(max(latencies, default=0), 4), 'sum': round(sum(latencies), 4)},
+                    'prompt_tokens': self.prompt_tokens[stage],
+                    'completion_tokens': self.completion_tokens[stage],
+                }
+            stages = {}
+            for name, seconds in self.stage_seconds.items():
+                rows = self.stage_rows[name]
+                stages[name] = {'seconds': round(seconds, 3), 'rows': rows, 'rows_per_second': round(rows / seconds, 2) if seconds and rows else None}
+
+            report = {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+                'wall_seconds': round(time.time() - self.started, 3),
+                'stages': stages,
+                'model_calls': model_calls,
+                'retries': {stage: dict(counts) for stage, counts in self.retries.items()},
+            }
+        report.update(extra or {})
+        return report
+
+    def writeReport(self, report, path):
+        writeAtomically(path, json.dumps(report, indent=2, default=str))
+        logger.info(f'Run report written to {path}')
+
+    def writePrometheus(self, report, path):
+        lines = [
+            '# HELP safetyai_wall_seconds Wall time of the last run.',
+            '# TYPE safetyai_wall_seconds gauge',
+            f'safetyai_wall_seconds {report["wall_seconds"]}',
+            '# HELP safetyai_stage_seconds Time spent in each stage of the last run.',
+            '# TYPE safetyai_stage_seconds gauge',
+        ]
+        lines += [f'safetyai_stage_seconds{{stage="{name}"}} {values["seconds"]}' for name, values in report['stages'].items()]
+        lines += ['# HELP safetyai_stage_rows Rows handled by each stage of the last run.', '# TYPE safetyai_stage_rows gauge']
+        lines += [f'safetyai_stage_rows{{stage="{name}"}} {values["rows"]}' for name, values in report['stages'].items()]
+        lines += ['# HELP safetyai_model_call_latency_seconds Latency of successful Azure OpenAI calls in the last run.', '# TYPE safetyai_model_call_latency_seconds summary']
+        for stage, values in report['model_calls'].items():
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')):
+                lines.append(f'safetyai_model_call_latency_seconds{{stage="{stage}",quantile="{quantile}"}} {values["latency_seconds"][key]}')
+            lines.append(f'safetyai_model_call_latency_seconds_sum{{stage="{stage}"}} {values["latency_seconds"]["sum"]}')
+            lines.append(f'safetyai_model_call_latency_seconds_count{{stage="{stage}"}} {values["calls"]}')
+        lines += ['# HELP safetyai_model_tokens Tokens reported by response.usage in the last run.', '# TYPE safetyai_model_tokens gauge']
+        for stage, values in report['model_calls'].items():
+            lines.append(f'safetyai_model_tokens{{stage="{stage}",kind="prompt"}} {values["prompt_tokens"]}')
+            lines.append(f'safetyai_model_tokens{{stage="{stage}",kind="completion"}} {values["completion_tokens"]}')
+        lines += ['# HELP safetyai_model_retries Retried Azure OpenAI errors by exception class in the last run.', '# TYPE safetyai_model_retries gauge']
+        for stage, counts in report['retries'].items():
+            lines += [f'safetyai_model_retries{{stage="{stage}",exception="{exception}"}} {count}' for exception, count in counts.items()]
+        writeAtomically(path, '\n'.join(lines) + '\n')
+        logger.info(f'Prometheus metrics written to {path}')
+
+
+def writeAtomically(path, content):
+    #The textfile collector may read at any moment, so the file is replaced in one rename
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as report_file:
+        report_file.write(content)
+    os.replace(temp_path, path)
+
+
+shared_metrics = RunMetrics()
@@ -0,0 +1,88 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Process-wide runtime context that creates the network clients on first use instead of at import, so CLI calls, the benchmark and every (sharded) worker process start fast.
+# -- One keep-alive httpx connection pool (dep.http_max_connections, dep.http_keepalive_expiry) and one AzureOpenAI client on top of it, shared by the improve and the parse step
+# -- One pooled SQLAlchemy engine (dep.db_pool_size) for every database read and write
+# The context belongs to the process that created it: a forked child builds its own clients and pool instead of reusing the parent's sockets, and spawned workers start without any.
+#################################################### OVERVIEW (END) ######################################################
+
+import dependencies as dep
+import httpx
+import logging
+import openai
+import os
+import threading
+import urllib.parse
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def httpLimits():
+    connections = max(dep.http_max_connections, dep.concurrency_max) # never fewer connections than in-flight requests
+    return httpx.Limits(max_connections=connections, max_keepalive_connections=connections, keepalive_expiry=dep.http_keepalive_expiry)
+
+def connectionString():
+    settings = dep.databaseSettings()
+    url_parse_pwd = urllib.parse.quote_plus(settings['password']) #due to sqlalchemy limitations: https://docs.sqlalchemy.org/en/14/core/engines.html#database-urls
+    return f"postgresql+psycopg2://{settings['user']}:{url_parse_pwd}@{settings['host']}:{settings['port']}/{settings['dbname']}"
+
+
+class RuntimeContext:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pid = None
+        self.http_client = None
+        self.azure_client = None
+        self.db_engine = None
+
+    def _ownProcess(self):
+        #Called with the lock held. After a fork the parent's pool is dropped without closing its connections, which still belong to the parent
+        if self.pid == os.getpid(): return
+        if self.db_engine is not None:
+            self.db_engine.dispose(close=False)
+        self.pid = os.getpid()
+        self.http_client = self.azure_client = self.db_engine = None
+
+    def httpClient(self):
+        with self.lock:
+            self._ownProcess()
+            if self.http_client is None:
+                self.http_client = httpx.Client(limits=httpLimits(), timeout=openai.DEFAULT_TIMEOUT, follow_redirects=True)
+            return self.http_client
+
+    def azureClient(self):
+        with self.lock:
+            self._ownProcess()
+            if self.azure_client is None:
+                self.azure_client = dep.client(self.httpClient())
+                logger.info(f'Created the Azure OpenAI client with a pool of {httpLimits().max_connections} keep-alive connections')
+            return self.azure_client
+
+    def asyncAzureClient(self):
+        #httpx.AsyncClient is bound to the event loop it is used on, so the async pipeline gets one per run, with the same pool settings
+        return dep.async_client(httpx.AsyncClient(limits=httpLimits(), timeout=openai.DEFAULT_TIMEOUT, follow_redirects=True))
+
+    def dbEngine(self):
+        with self.lock:
+            self._ownProcess()
+            if self.db_engine is None:
+                from sqlalchemy import create_engine # only processes that touch the database pay for importing sqlalchemy
+                #pool_pre_ping replaces connections the server or the network dropped between two batches
+                self.db_engine = create_engine(connectionString(), pool_size=dep.db_pool_size, max_overflow=dep.db_pool_size, pool_pre_ping=True, pool_recycle=dep.db_pool_recycle)
+            return self.db_engine
+
+    def close(self):
+        with self.lock:
+            if self.pid != os.getpid(): return
+            if self.http_client is not None:
+                self.http_client.close()
+            if self.db_engine is not None:
+                self.db_engine.dispose()
+            self.pid = None
+            self.http_client = self.azure_client = self.db_engine = None
+
+
+shared_context = RuntimeContext()
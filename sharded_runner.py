@@ -0,0 +1,171 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Sharded execution mode (python main.py --shards N --processes P --run-id ID) for scaling over several cores and several AKS pods.
+# The selected idmemo keyspace is split by hash into N shards. The shards of a run are rows in a Postgres lease table, and workers claim them with SELECT ... FOR UPDATE SKIP LOCKED,
+# so any number of worker processes in any number of pods can pull shards concurrently without processing the same shard twice.
+# Each worker is a separate (spawned) process with its own Azure OpenAI clients, connection pool and journal, and writes its own results.
+# A claimed shard is kept alive by a heartbeat; if a worker dies, its lease expires and another worker picks the shard up, and only rows without results are selected again.
+#################################################### OVERVIEW (END) ######################################################
+
+import checkpoint_journal as journal
+import database_connection as dbConn
+import dependencies as dep
+import logging
+import multiprocessing
+import os
+import rate_limiter as rateLim
+import socket
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+## ------ VARIABLES ------ ##
+lease_table = dep.lease_table or f'{dep.destination_table}_shard_leases'
+
+lease_table_sql = f"""CREATE TABLE IF NOT EXISTS {lease_table} (
+                        run_id TEXT NOT NULL, shard_id INTEGER NOT NULL, shard_count INTEGER NOT NULL, owner TEXT, leased_until TIMESTAMPTZ,
+                        completed_at TIMESTAMPTZ, rows_processed INTEGER, attempts INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (run_id, shard_id))
+                    """
+run_lock_sql = "SELECT pg_advisory_xact_lock(hashtext(%s))"
+run_shards_sql = f"SELECT shard_count FROM {lease_table} WHERE run_id = %s LIMIT 1"
+create_shards_sql = f"INSERT INTO {lease_table} (run_id, shard_id, shard_count) SELECT %s, shard_id, %s FROM generate_series(0, %s - 1) AS shard_id"
+claim_sql = f"""/*skip shards another worker holds a row lock on, instead of waiting for it*/
+                UPDATE {lease_table} SET owner = %s, leased_until = now() + make_interval(secs => %s), attempts = attempts + 1
+                WHERE (run_id, shard_id) = (SELECT run_id, shard_id FROM {lease_table}
+                                            WHERE run_id = %s AND completed_at IS NULL AND (leased_until IS NULL OR leased_until < now())
+                                            ORDER BY shard_id LIMIT 1 FOR UPDATE SKIP LOCKED)
+                RETURNING shard_id, shard_count
+            """
+renew_sql = f"UPDATE {lease_table} SET leased_until = now() + make_interval(secs => %s) WHERE run_id = %s AND shard_id = %s AND owner = %s AND completed_at IS NULL"
+complete_sql = f"UPDATE {lease_table} SET completed_at = now(), rows_processed = %s WHERE run_id = %s AND shard_id = %s AND owner = %s"
+progress_sql = f"SELECT count(*) FILTER (WHERE completed_at IS NOT NULL), count(*), COALESCE(sum(rows_processed), 0) FROM {lease_table} WHERE run_id = %s"
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def shardSelect(shard_id, shard_count):
+    #hashtext() is the same in every session of a postgres version, so every pod partitions the keyspace the same way
+    return f"{dep.SELECT_sql_script.rstrip()} AND mod(hashtext(INPUT_DATA_TABLE.idmemo::text)::bigint + 2147483648, {shard_count}) = {shard_id}"
+
+def taggedPath(path, tag):
+    root, extension = os.path.splitext(path)
+    return f'{root}{tag}{extension}'
+
+def execute(sql_text, params=(), fetch=False):
+    #Runs one statement in its own transaction on a pooled connection
+    with dbConn.pooledConnection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql_text, params)
+                result = cursor.fetchone() if fetch else cursor.rowcount
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def prepareRun(run_id, shard_count):
+    #The first process of a run refreshes the unchanged rows and creates the shards. The advisory lock makes pods started at the same time wait for it instead of racing
+    with dbConn.pooledConnection() as conn:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(run_lock_sql, (lease_table,))
+                cursor.execute(lease_table_sql)
+                cursor.execute(run_shards_sql, (run_id,))
+                existing = cursor.fetchone()
+                if existing:
+                    logger.info(f'Joining sharded run {run_id} with {existing[0]} shards')
+                    cursor.execute(progress_sql, (run_id,))
+                    completed_shards, total_shards, _ = cursor.fetchone()
+                    if completed_shards == total_shards:
+                        logger.warning(f'Sharded run {run_id} is already completed, nothing is processed. Start a new run with a new --run-id')
+                else:
+                    dbConn.refreshUnchangedRows()
+                    cursor.execute(create_shards_sql, (run_id, shard_count, shard_count))
+                    logger.info(f'Created sharded run {run_id} with {shard_count} shards')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def claimShards(run_id, owner):
+    #Yields (shard_id, shard_count) until no shard of the run is left unfinished and unleased
+    while True:
+        claimed = execute(claim_sql, (owner, dep.shard_lease_seconds, run_id), fetch=True)
+        if claimed is None: return
+        yield claimed
+
+
+class LeaseHeartbeat:
+    #Renews the lease of the shard being processed, a third of the lease time before it would expire
+    def __init__(self, run_id, shard_id, owner):
+        self.run_id = run_id
+        self.shard_id = shard_id
+        self.owner = owner
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(dep.shard_lease_seconds / 3):
+            try:
+                if execute(renew_sql, (dep.shard_lease_seconds, self.run_id, self.shard_id, self.owner)) == 0:
+                    logger.warning(f'Lost the lease on shard {self.shard_id}, another worker may process it again')
+            except Exception as e:
+                logger.error(f'Failed to renew the lease on shard {self.shard_id}: {e}')
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def workerMain(args, worker_number):
+    #Entry point of one worker process: claims shards until the run is done, then writes its own journal, export and run report
+    import main # imported here because main imports this module
+
+    __logger = main.configure_logging()
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    dep.output_tag = f'_worker{worker_number}'
+    dep.run_report_path = taggedPath(dep.run_report_path, dep.output_tag)
+    journal.shared_journal.path = taggedPath(dep.journal_path, dep.output_tag)
+    #The quota is shared by the workers of this pod, the x-ratelimit-remaining-* headers keep the pods in check between each other
+    processes = max(args.processes, 1)
+    rateLim.shared_limiter = rateLim.RateLimiter(dep.requests_per_minute / processes, dep.tokens_per_minute / processes)
+
+    completed = journal.shared_journal.start(args.resume)
+    shards_done, rows_done = 0, 0
+    for shard_id, shard_count in claimShards(args.run_id, owner):
+        __logger.info(f'{owner} claimed shard {shard_id + 1}/{shard_count}')
+        with LeaseHeartbeat(args.run_id, shard_id, owner):
+            rows = main.processSelection(dbConn.databaseConnection(), shardSelect(shard_id, shard_count), args, __logger, completed)
+        execute(complete_sql, (rows, args.run_id, shard_id, owner))
+        shards_done += 1
+        rows_done += rows
+        __logger.info(f'{owner} finished shard {shard_id + 1}/{shard_count} with {rows} rows')
+
+    main.finishRun(args)
+    return {'owner': owner, 'shards': shards_done, 'rows': rows_done}
+
+
+def runSharded(args):
+    prepareRun(args.run_id, args.shards)
+
+    if args.processes <= 1:
+        results = [workerMain(args, 0)]
+    else:
+        #spawn: every worker starts from a clean interpreter, no clients, sockets or connection pools are inherited from this process
+        with ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(workerMain, [args] * args.processes, range(args.processes)))
+
+    for result in results:
+        logger.info(f"Worker {result['owner']} processed {result['shards']} shards and {result['rows']} rows")
+    completed_shards, total_shards, total_rows = execute(progress_sql, (args.run_id,), fetch=True)
+    logger.info(f'Sharded run {args.run_id}: {completed_shards}/{total_shards} shards completed, {total_rows} rows processed by all pods')
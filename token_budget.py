@@ -0,0 +1,167 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Token budget applied before the improve and parse requests, so very long memos no longer cause slow calls, timeouts and TPM spikes that starve the other workers.
+# Tokens are counted locally with the BPE tokenizer of the engine (tiktoken, dep.tokenizer_encoding), loaded from the copy in dep.tokenizer_dir; the runs never download it.
+# Fetch it once when installing or building the image with: python token_budget.py --download (see Getting Started in the README). Without tiktoken or the file, tokens are approximated from the text length like in rate_limiter.py.
+# -- Improve: descriptions longer than dep.improve_chunk_tokens are split at sentence boundaries and improved chunk by chunk, at most dep.improve_max_chunks chunks per report
+# -- Parse: improved texts longer than dep.parse_max_input_tokens are trimmed at a sentence boundary
+# -- max_tokens of an improve request follows the input length, capped at dep.improve_max_tokens. A parse answer is a few names from the category list, whatever the input length, so it keeps dep.parse_max_tokens
+#################################################### OVERVIEW (END) ######################################################
+
+import argparse
+import dependencies as dep
+import hashlib
+import logging
+import os
+import rate_limiter as rateLim
+import re
+import threading
+
+## ------ VARIABLES ------ ##
+tokenizer_url = 'https://openaipublic.blob.core.windows.net/encodings/{encoding}.tiktoken'
+improve_output_ratio = 1.5 # completion tokens per input token, the improved text can be a bit longer than the original
+improve_output_floor = 32 # completion tokens every improve request gets, however short the input
+sentence_end = re.compile(r'(?<=[.!?])\s+|\n+')
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def tokenizerDirectory(directory):
+    #Relative to this file, so the copy shipped with the code is found (and stored) independent of the working directory
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), directory))
+
+def tokenizerFile(directory, encoding):
+    #tiktoken looks up its cache by the sha1 of the download url
+    return os.path.join(directory, hashlib.sha1(tokenizer_url.format(encoding=encoding).encode()).hexdigest())
+
+
+class TokenBudget:
+    def __init__(self, encoding, directory):
+        self.encoding = encoding
+        self.directory = tokenizerDirectory(directory)
+        self.tokenizer = None
+        self.loaded = False
+        self.split_rows = 0
+        self.trimmed_rows = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        #Loaded on first use. Only from the local copy, a missing file falls back to the approximation instead of a download
+        with self.lock:
+            if self.loaded: return self.tokenizer
+            self.loaded = True
+            try:
+                import tiktoken
+            except ImportError:
+                logger.warning('tiktoken is not installed, token counts are approximated from the text length')
+                return None
+            if not os.path.exists(tokenizerFile(self.directory, self.encoding)):
+                logger.warning(f'No {self.encoding} tokenizer in {self.directory} (run python token_budget.py --download), token counts are approximated from the text length')
+                return None
+            os.environ['TIKTOKEN_CACHE_DIR'] = os.path.abspath(self.directory)
+            try:
+                self.tokenizer = tiktoken.get_encoding(self.encoding)
+            except Exception as e:
+                logger.warning(f'Could not load the {self.encoding} tokenizer from {self.directory} ({e}), token counts are approximated from the text length')
+            return self.tokenizer
+
+    def countTokens(self, text):
+        tokenizer = self._load()
+        if tokenizer is None:
+            return len(text) // rateLim.chars_per_token + 1
+        return len(tokenizer.encode(text, disallowed_special=()))
+
+    def requestTokens(self, messages, max_tokens):
+        #Same as rateLim.estimateTokens, with counted instead of approximated prompt tokens
+        return sum(self.countTokens(message['content']) + rateLim.tokens_per_message for message in messages) + max_tokens
+
+    def improveMaxTokens(self, text):
+        return min(dep.improve_max_tokens, int(self.countTokens(text) * improve_output_ratio) + improve_output_floor)
+
+    def _hardSplit(self, text, max_tokens):
+        #For a single sentence above the budget: cut at token (or approximated character) boundaries
+        tokenizer = self._load()
+        if tokenizer is None:
+            step = max_tokens * rateLim.chars_per_token
+            return [text[i:i + step] for i in range(0, len(text), step)]
+        tokens = tokenizer.encode(text, disallowed_special=())
+        return [tokenizer.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+    def splitText(self, text, max_tokens):
+        #Greedy packing of whole sentences into chunks of at most max_tokens
+        if self.countTokens(text) <= max_tokens: return [text]
+
+        chunks, chunk, chunk_tokens = [], [], 0
+        for sentence in filter(None, (part.strip() for part in sentence_end.split(text))):
+            sentence_tokens = self.countTokens(sentence)
+            if sentence_tokens > max_tokens:
+                pieces = self._hardSplit(sentence, max_tokens)
+            else:
+                pieces = [sentence]
+            for piece in pieces:
+                piece_tokens = sentence_tokens if len(pieces) == 1 else self.countTokens(piece)
+                if chunk and chunk_tokens + piece_tokens > max_tokens:
+                    chunks.append(' '.join(chunk))
+                    chunk, chunk_tokens = [], 0
+                chunk.append(piece)
+                chunk_tokens += piece_tokens
+        if chunk: chunks.append(' '.join(chunk))
+        return chunks
+
+    def improveChunks(self, text):
+        #The parts of a description that are improved in separate requests, anything beyond dep.improve_max_chunks is dropped
+        chunks = self.splitText(str(text), dep.improve_chunk_tokens)
+        if len(chunks) > 1:
+            with self.lock:
+                self.split_rows += 1
+                if len(chunks) > dep.improve_max_chunks: self.trimmed_rows += 1
+        return chunks[:dep.improve_max_chunks]
+
+    def trimText(self, text, max_tokens):
+        chunks = self.splitText(str(text), max_tokens)
+        if len(chunks) > 1:
+            with self.lock:
+                self.trimmed_rows += 1
+        return chunks[0]
+
+    def stats(self):
+        with self.lock:
+            return {'tokenizer': self.encoding if self.tokenizer is not None else 'approximate', 'split_rows': self.split_rows, 'trimmed_rows': self.trimmed_rows}
+
+    def logStats(self):
+        if not self.split_rows and not self.trimmed_rows: return
+        stats = self.stats()
+        logger.info(f"Token budget ({stats['tokenizer']}): {stats['split_rows']} descriptions split into chunks, {stats['trimmed_rows']} texts trimmed")
+
+
+def download(directory, encoding):
+    #Needs network access once, e.g. when the image is built. The runs themselves only read the file, from the same directory TokenBudget resolves
+    import tiktoken
+    directory = tokenizerDirectory(directory)
+    os.makedirs(directory, exist_ok=True)
+    os.environ['TIKTOKEN_CACHE_DIR'] = directory
+    tiktoken.get_encoding(encoding)
+    if not os.path.exists(tokenizerFile(directory, encoding)):
+        raise FileNotFoundError(f'tiktoken did not store the {encoding} tokenizer in {directory}')
+    print(f'Stored the {encoding} tokenizer in {tokenizerFile(directory, encoding)}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local tokenizer used for the token budget of the AI requests')
+    parser.add_argument('--download', action='store_true', help=f'fetch the {dep.tokenizer_encoding} tokenizer into {dep.tokenizer_dir}')
+    parser.add_argument('--count', help='print the number of tokens of this text')
+    args = parser.parse_args(argv)
+
+    if args.download:
+        download(dep.tokenizer_dir, dep.tokenizer_encoding)
+    if args.count is not None:
+        print(f"{shared_budget.countTokens(args.count)} tokens ({shared_budget.stats()['tokenizer']})")
+
+
+shared_budget = TokenBudget(dep.tokenizer_encoding, dep.tokenizer_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#################################################### OVERVIEW (START) ####################################################
+# LAST CHANGES [AUTHOR]: agent
+# LAST CHANGES [DATE]: 18.10.2026
+#
+# DESCRIPTION
+# Offline topic pre-classifier that runs before parsing_topics_gpt_35_turbo.py. The improved descriptions and every entry in categories.txt are turned into hashed bag-of-words vectors,
+# and a single NumPy matrix product gives the coverage of every category by every report (no network, no GPU): the IDF-weighted share of the category's words that occur in the report.
+# Unlike cosine similarity the coverage does not drop as a report gets longer, so it is comparable between one-line and multi-paragraph reports.
+# Reports where the best category scores at least dep.preclassify_threshold get their topics assigned locally, only the ambiguous ones are sent to aiTopicResponse.
+# A share (dep.preclassify_audit_rate) of the locally classified reports is still sent to the model, and the agreement between the two is reported at the end of the run for tuning the threshold.
+#################################################### OVERVIEW (END) ######################################################
+
+import dependencies as dep
+import logging
+import numpy as np
+import parsing_topics_gpt_35_turbo as parsTop
+import random
+import re
+import threading
+import zlib
+
+## ------ VARIABLES ------ ##
+stop_words = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have', 'in', 'is', 'it', 'of', 'on', 'or', 'other', 'that', 'the', 'this', 'to', 'was', 'were', 'with'}
+suffixes = ('ations', 'ation', 'ings', 'ing', 'ions', 'ion', 'ment', 'ness', 'ies', 'ed', 'es', 's')
+
+## ------ FUNCTIONS ------ ##
+logger = logging.getLogger(__name__)
+
+def tokenize(text):
+    tokens = []
+    for word in re.findall(r"[a-z]+", str(text).lower()):
+        if word in stop_words or len(word) < 2: continue
+        for suffix in suffixes: #crude stemming, so 'failed'/'failure' and 'leaks'/'leaking' end up in the same bucket more often
+            if len(word) > len(suffix) + 3 and word.endswith(suffix):
+                word = word[:-len(suffix)]
+                break
+        tokens.append(word)
+    return tokens
+
+def hashedCounts(texts, hash_dim):
+    #Bag-of-words counts, hashed with crc32 (stable between runs and processes, unlike hash())
+    counts = np.zeros((len(texts), hash_dim), dtype=np.float32)
+    for i, text in enumerate(texts):
+        buckets = [zlib.crc32(token.encode('utf-8')) % hash_dim for token in tokenize(text)]
+        np.add.at(counts[i], buckets, 1)
+    return counts
+
+
+class TopicPreclassifier:
+    def __init__(self, categories, threshold, audit_rate, hash_dim=dep.preclassify_hash_dim, max_topics=6):
+        self.categories = [str(category).strip() for category in categories] if categories is not None else None
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.hash_dim = hash_dim
+        self.max_topics = max_topics
+        self.category_weights = None
+        self.lock = threading.Lock()
+        self.local_rows = 0
+        self.llm_rows = 0
+        self.audited_rows = 0
+        self.jaccard_sum = 0.0
+        self.top1_hits = 0
+
+    def _fit(self):
+        #Built on first use; document frequencies are counted over the category list itself, so words shared by many categories ('inadequate', 'failure') weigh little
+        if self.category_weights is None:
+            if self.categories is None:
+                self.categories = [str(category).strip() for category in dep.topic_categ] # categories.txt is only read once the pre-classifier is used
+            presence = (hashedCounts(self.categories, self.hash_dim) > 0).astype(np.float32)
+            idf = np.log((1 + len(self.categories)) / (1 + presence.sum(axis=0))) + 1
+            weights = presence * idf
+            self.category_weights = weights / np.where(weights.sum(axis=1, keepdims=True) == 0, 1, weights.sum(axis=1, keepdims=True)) # each category's weights sum to 1
+        return self.category_weights
+
+    def similarities(self, texts):
+        #Coverage in [0, 1]: 1 when every word of the category occurs in the report, however many other words the report has
+        category_weights = self._fit()
+        text_presence = (hashedCounts(texts, self.hash_dim) > 0).astype(np.float32)
+        return text_presence @ category_weights.T
+
+    def classify(self, texts):
+        #Returns one entry per text: the list of local topics, or None when the text is ambiguous and should go to the model
+        if not texts: return []
+        scores = self.similarities(texts)
+        ranking = np.argsort(-scores, axis=1)[:, :self.max_topics]
+        topics = []
+        for row_scores, row_ranking in zip(scores, ranking):
+            selected = [self.categories[i] for i in row_ranking if row_scores[i] >= self.threshold]
+            topics.append(selected or None)
+        return topics
+
+    def split(self, rows):
+        #Returns (results assigned locally, rows that need the model, {row index: local topics} of the audited rows among them)
+        classified = self.classify([row['aiimproveddescription'] for row in rows])
+        results, llm_rows, audited = [], [], {}
+        for row, topics in zip(rows, classified):
+            if topics is None:
+                llm_rows.append(row)
+            elif random.random() < self.audit_rate:
+                llm_rows.append(row)
+                audited[row.name] = topics
+            else:
+                results.append(parsTop.topicUpdates(row, '\n'.join(topics)))
+
+        with self.lock:
+            self.local_rows += len(results)
+            self.llm_rows += len(llm_rows)
+        return results, llm_rows, audited
+
+    def audit(self, audited, llm_topics):
+        #Compares the local topics with the topics the model returned for the same rows
+        for row_index, local_topics in audited.items():
+            model_topics = llm_topics.get(row_index)
+            if not isinstance(model_topics, list): continue #the model call failed, nothing to compare
+            local_set = {topic.lower() for topic in local_topics}
+            model_set = {topic.strip().lower() for topic in model_topics if topic.strip()}
+            union = local_set | model_set
+            with self.lock:
+                self.audited_rows += 1
+                self.jaccard_sum += len(local_set & model_set) / len(union) if union else 1.0
+                self.top1_hits += local_topics[0].lower() in model_set
+
+    def stats(self):
+        with self.lock:
+            total = self.local_rows + self.llm_rows
+            return {'threshold': self.threshold, 'local_rows': self.local_rows, 'llm_rows': self.llm_rows,
+                    'local_ratio': round(self.local_rows / total, 4) if total else 0, 'audited_rows': self.audited_rows,
+                    'mean_jaccard': round(self.jaccard_sum / self.audited_rows, 4) if self.audited_rows else None,
+                    'top1_agreement': round(self.top1_hits / self.audited_rows, 4) if self.audited_rows else None}
+
+    def logReport(self):
+        stats = self.stats()
+        total = stats['local_rows'] + stats['llm_rows']
+        if not total: return
+        logger.info(f"Topic pre-classifier (threshold {stats['threshold']}): {stats['local_rows']}/{total} rows ({stats['local_ratio']:.1%}) classified locally, {stats['llm_rows']} sent to the model")
+        if stats['audited_rows']:
+            logger.info(f"Topic pre-classifier agreement with the model on {stats['audited_rows']} audited rows: mean Jaccard {stats['mean_jaccard']:.2f}, top-1 topic agreement {stats['top1_agreement']:.1%}")
+
+
+shared_preclassifier = TopicPreclassifier(None, dep.preclassify_threshold, dep.preclassify_audit_rate)